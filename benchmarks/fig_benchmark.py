@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+# Benchmark suite for the cadmus.fig pipeline. A synthetic source tree is
+# generated, with many directories, many targets per configuration file, large
+# sources and multi-page documents, and the stages of the pipeline are timed
+# against it:
+#
+#   sources cold    generate_source_files() into an empty build tree
+#   sources no-op   generate_source_files() with nothing to write
+#   figures cold    generate_figures() with an empty build cache
+#   figures no-op   generate_figures() with every target up to date
+#
+# By default the external tools are replaced by stubs (stub_toolchain.py) with
+# a configurable latency. This measures the orchestration, walking, template
+# and scheduling costs of the pipeline without TeX installed. Use
+# '--toolchain real' to run the same corpus against lualatex, ghostscript and
+# ImageMagick for end-to-end numbers.
+#
+# Example:
+#   python benchmarks/fig_benchmark.py --dirs 50 --targets 20 --jobs 8
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import stat
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cadmus.fig.src_utils import generate_source_files  # noqa: E402
+from cadmus.fig.build_utils import (generate_figures,  # noqa: E402
+                                    get_raster_outputs)
+from cadmus.fig.manifest import read_manifest  # noqa: E402
+from cadmus.fig.common import (CFG_FILE_NAME,  # noqa: E402
+                               MANIFEST_FILE_NAME)
+from cadmus.fig.store import parse_size  # noqa: E402
+
+STUB_TOOLS = ['lualatex', 'gs', 'pdftoppm', 'convert']
+
+TEMPLATE = r"""%! @insertdocumentclass
+\documentclass[10pt]{article}
+%! @insertpackagehead
+\usepackage{amsmath}
+%! @insertpackagetail
+%! @insertpreamble
+\pagestyle{empty}
+\begin{document}
+%! @insertcode
+\end{document}
+"""
+
+
+def write_stub_toolchain(bin_dir):
+    # Write a wrapper script for each tool which calls the stub with the name
+    # of the tool as the first argument.
+    stub = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'stub_toolchain.py')
+    for tool in STUB_TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nexec "{}" "{}" {} "$@"\n'
+                    .format(sys.executable, stub, tool))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    return
+
+
+def generate_source(rng, lines, pages):
+    # Generate the source of a figure with the given number of lines of
+    # content, spread out over the given number of pages.
+    source = []
+    if rng.random() < 0.25:
+        source.append('\\usepackage{amssymb}\n')
+    for page in range(pages):
+        if page > 0:
+            source.append('\\newpage\n')
+        for i in range(max(1, lines // pages)):
+            source.append('Line {}: $a_{{{}}} + b^{{{}}} = '
+                          '\\sum_{{k=0}}^{{{}}} c_k$\\par\n'
+                          .format(i, i, page, i))
+    return ''.join(source)
+
+
+def generate_corpus(root_dir, dirs, targets, depth, lines, large_lines,
+                    pages, seed):
+    # Generate a source tree with a configuration file in each of 'dirs'
+    # directories, nested 'depth' levels deep, and 'targets' targets per
+    # configuration file. Every tenth target is large and every fourth target
+    # is a multi-page document whose last page is the figure. Returns the
+    # path to the template and the number of targets.
+    rng = random.Random(seed)
+    template = os.path.join(root_dir, 'template.tex')
+    with open(template, 'w') as f:
+        f.write(TEMPLATE)
+
+    count = 0
+    for d in range(dirs):
+        parts = ['group{}'.format(d % max(1, dirs // 10))]
+        parts += ['level{}'.format(k) for k in range(1, depth)]
+        parts.append('dir{}'.format(d))
+        source_dir = os.path.join(root_dir, 'src', *parts)
+        os.makedirs(source_dir)
+
+        cfg = {'default': {'passes': 2}, 'targets': []}
+        for k in range(targets):
+            file_name = 'figure{}.tex'.format(k)
+            n_pages = pages if count % 4 == 3 else 1
+            n_lines = large_lines if count % 10 == 9 else lines
+            with open(os.path.join(source_dir, file_name), 'w') as f:
+                f.write(generate_source(rng, n_lines, n_pages))
+
+            target = {'file_name': file_name, 'page': n_pages}
+            if count % 3 == 0:
+                target['format'] = 'png'
+            cfg['targets'].append(target)
+            count += 1
+
+        with open(os.path.join(source_dir, CFG_FILE_NAME), 'w') as f:
+            json.dump(cfg, f)
+
+    return (template, count)
+
+
+def measure(name, func, repeat, reset=None):
+    # Time the function, calling the reset function before each run. The
+    # output printed by the pipeline is discarded.
+    times = []
+    for r in range(repeat):
+        if reset:
+            reset()
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+
+    result = {
+        'name': name,
+        'min': min(times),
+        'median': statistics.median(times),
+        'max': max(times)
+    }
+    print('{:<16} {:>10.3f} {:>10.3f} {:>10.3f}'
+          .format(name, result['min'], result['median'], result['max']))
+    return result
+
+
+def check_figures(build_root_dir, output_root_dir, count, results):
+    # Fail the benchmark unless every target was built and its images
+    # exist, since a failing build would otherwise pass as a fast one.
+    failed = sorted(t for (t, r) in results.items() if not r)
+    if len(results) != count or failed:
+        raise ValueError('{} of {} target(s) failed to build: {}'.format(
+            count - len(results) + len(failed), count,
+            ', '.join(failed) or 'targets missing'))
+
+    missing = []
+    for t in read_manifest(build_root_dir) or []:
+        for (f, w, p) in get_raster_outputs(
+            t['name'], os.path.join(output_root_dir, t['local_dir']),
+            t['match']['format'], t['match']['width']
+        ):
+            if not os.path.exists(p):
+                missing.append(p)
+    if missing:
+        raise ValueError('{} image(s) missing, e.g. \'{}\'.'
+                         .format(len(missing), missing[0]))
+    return
+
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix='cadmus_benchmark_')
+    try:
+        if args.toolchain == 'stub':
+            bin_dir = os.path.join(work_dir, 'bin')
+            os.makedirs(bin_dir)
+            write_stub_toolchain(bin_dir)
+            os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+            os.environ['CADMUS_STUB_LATENCY'] = str(args.latency)
+            if args.latex_latency is not None:
+                os.environ['CADMUS_STUB_LATENCY_LUALATEX'] = \
+                    str(args.latex_latency)
+        else:
+            tools = ['lualatex', 'gs', 'convert']
+            if args.raster_backend == 'pdftoppm':
+                tools.append('pdftoppm')
+            missing = [tool for tool in tools if not shutil.which(tool)]
+            if missing:
+                raise ValueError('The real toolchain is missing: ' +
+                                 ', '.join(missing) + '.')
+
+        (template, count) = generate_corpus(
+            work_dir, args.dirs, args.targets, args.depth, args.lines,
+            args.large_lines, args.pages, args.seed)
+        source_root_dir = os.path.join(work_dir, 'src')
+        build_root_dir = os.path.join(work_dir, 'build')
+        output_root_dir = os.path.join(work_dir, 'out')
+
+        print('Corpus: {} targets in {} directories ({} toolchain, {} jobs).'
+              .format(count, args.dirs, args.toolchain, args.jobs))
+        print('{:<16} {:>10} {:>10} {:>10}'
+              .format('stage [s]', 'min', 'median', 'max'))
+
+        def remove_tree(path):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+
+        def sources():
+            generate_source_files(source_root_dir, build_root_dir, template,
+                                  None, args.precompile_preamble)
+
+        def figures():
+            results = generate_figures(
+                build_root_dir, output_root_dir, 'jpg', False, False,
+                jobs=args.jobs, adaptive=args.adaptive, batch=args.batch,
+                batch_size=args.batch_size,
+                raster_backend=args.raster_backend,
+                supersample=args.supersample, scratch_dir=args.scratch_dir,
+                max_memory=args.max_memory, optimize=args.optimize)
+            check_figures(build_root_dir, output_root_dir, count, results)
+
+        def reset_figures():
+            # Remove every build product, keeping the generated sources.
+            remove_tree(output_root_dir)
+            for (root_dir, dir_names, file_names) in os.walk(build_root_dir):
+                for file_name in file_names:
+                    if file_name != MANIFEST_FILE_NAME and \
+                       not file_name.endswith('.tex'):
+                        os.remove(os.path.join(root_dir, file_name))
+
+        results = [
+            measure('sources cold', sources, args.repeat,
+                    lambda: remove_tree(build_root_dir)),
+            measure('sources no-op', sources, args.repeat)
+        ]
+        if not args.sources_only:
+            results += [
+                measure('figures cold', figures, args.repeat, reset_figures),
+                measure('figures no-op', figures, args.repeat)
+            ]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        'settings': vars(args),
+        'targets': count,
+        'results': results
+    }
+
+
+parser = argparse.ArgumentParser(
+    description='Benchmark the cadmus figure pipeline.')
+
+parser.add_argument('--toolchain',
+                    help='Run against the stub toolchain or the real one.',
+                    choices=['stub', 'real'],
+                    default='stub')
+
+parser.add_argument('--latency',
+                    help='Specify the time in seconds each call to a stub '
+                         'tool takes.',
+                    type=float,
+                    default=0.0)
+
+parser.add_argument('--latex-latency',
+                    help='Specify the time in seconds each call to the stub '
+                         'lualatex takes. Defaults to --latency.',
+                    type=float,
+                    default=None)
+
+parser.add_argument('--dirs',
+                    help='Specify the number of directories with a '
+                         'configuration file.',
+                    type=int,
+                    default=20)
+
+parser.add_argument('--targets',
+                    help='Specify the number of targets per directory.',
+                    type=int,
+                    default=10)
+
+parser.add_argument('--depth',
+                    help='Specify the nesting depth of the directories.',
+                    type=int,
+                    default=2)
+
+parser.add_argument('--lines',
+                    help='Specify the number of lines in a source.',
+                    type=int,
+                    default=20)
+
+parser.add_argument('--large-lines',
+                    help='Specify the number of lines in a large source.',
+                    type=int,
+                    default=2000)
+
+parser.add_argument('--pages',
+                    help='Specify the number of pages in a multi-page '
+                         'document.',
+                    type=int,
+                    default=5)
+
+parser.add_argument('--seed',
+                    help='Specify the seed used to generate the corpus.',
+                    type=int,
+                    default=0)
+
+parser.add_argument('--repeat',
+                    help='Specify the number of times each stage is run.',
+                    type=int,
+                    default=3)
+
+parser.add_argument('--jobs', '-j',
+                    help='Specify the number of targets to build in parallel.',
+                    type=int,
+                    default=os.cpu_count() or 1)
+
+parser.add_argument('--adaptive-passes',
+                    dest='adaptive',
+                    help='Build with adaptive passes.',
+                    action='store_true')
+
+parser.add_argument('--precompile-preamble',
+                    help='Build with precompiled preamble formats.',
+                    action='store_true')
+
+parser.add_argument('--batch',
+                    help='Build in batch mode.',
+                    action='store_true')
+
+parser.add_argument('--batch-size',
+                    help='Specify the maximum number of figures per batch.',
+                    type=int,
+                    default=20)
+
+parser.add_argument('--raster-backend',
+                    help='Specify the rasterization backend.',
+                    choices=['convert', 'gs', 'pdftoppm', 'inprocess'],
+                    default='convert')
+
+parser.add_argument('--supersample',
+                    help='Specify the supersampling factor of the \'gs\' and '
+                         '\'pdftoppm\' backends.',
+                    type=float,
+                    default=2)
+
+parser.add_argument('--scratch-dir',
+                    help='Build each figure in a temporary directory below '
+                         'the specified directory, e.g. \'/dev/shm\'.',
+                    default=None)
+
+parser.add_argument('--max-memory',
+                    help='Specify the memory budget for rasterization, e.g. '
+                         '\'2G\'.',
+                    type=parse_size,
+                    default=None)
+
+parser.add_argument('--optimize',
+                    help='Optimize the images once rasterized.',
+                    action='store_true')
+
+parser.add_argument('--sources-only',
+                    help='Only benchmark the generation of the sources.',
+                    action='store_true')
+
+parser.add_argument('--output',
+                    help='Write the results to the specified file as JSON, '
+                         'e.g. to compare against an earlier run.',
+                    default=None)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
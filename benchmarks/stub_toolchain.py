@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# Stand-in for the external tools called by cadmus.fig, used by the benchmark
+# suite to measure the cost of the pipeline itself without TeX installed. The
+# tool to emulate is given as the first argument, e.g.
+#   stub_toolchain.py lualatex --draftmode figure.tex
+# Every call sleeps for a configurable time to model the latency of the real
+# tool, given in seconds by the environment variable
+# CADMUS_STUB_LATENCY_<TOOL>, falling back to CADMUS_STUB_LATENCY.
+#
+# The stubs only emulate what the pipeline depends on: the PDF written by
+# lualatex is a text file holding the number of pages and the media box, the
+# bounding box reported by ghostscript is fixed and the images are
+# placeholders.
+import os
+import re
+import sys
+import time
+
+STUB_PDF_HEADER = '%PDF-stub pages='
+
+# US Letter, the size of every page written by lualatex.
+PAGE_SIZE = (612.0, 792.0)
+
+
+def sleep(tool):
+    latency = os.environ.get('CADMUS_STUB_LATENCY_' + tool.upper(),
+                             os.environ.get('CADMUS_STUB_LATENCY', '0'))
+    time.sleep(float(latency))
+    return
+
+
+def read_page_count(path):
+    with open(path) as f:
+        header = f.readline()
+    if not header.startswith(STUB_PDF_HEADER):
+        raise ValueError('Not a stub PDF: ' + path)
+    return int(header[len(STUB_PDF_HEADER):])
+
+
+def write_pdf(path, pages, size=PAGE_SIZE):
+    with open(path, 'w') as f:
+        f.write(STUB_PDF_HEADER + str(pages) + '\n')
+        f.write('/MediaBox [0 0 {:.2f} {:.2f}]\n'.format(*size))
+    return
+
+
+def write_image(path):
+    with open(path, 'wb') as f:
+        f.write(b'cadmus stub image\n')
+    return
+
+
+def lualatex(args):
+    if '--version' in args:
+        print('This is LuaTeX, Version 1.0 (cadmus stub)')
+        return 0
+
+    sleep('lualatex')
+    if '-ini' in args:
+        # Dump a format, i.e. write an empty file named after the job.
+        jobname = next(a.split('=', 1)[1] for a in args
+                       if a.startswith('-jobname='))
+        with open(jobname + '.fmt', 'w') as f:
+            f.write('')
+        return 0
+
+    file = [a for a in args if not a.startswith('-')][-1]
+    name = os.path.splitext(os.path.basename(file))[0]
+    with open(file) as f:
+        source = f.read()
+
+    # Count the pages. In a batch document every figure starts on a new page
+    # and its first page is written to the log.
+    log = ['This is LuaTeX, Version 1.0 (cadmus stub)']
+    pages = 0
+    figures = source.split('\\directlua')
+    if len(figures) > 1:
+        for figure in figures[1:]:
+            match = re.search(r'cadmus-batch-page: (\d+)', figure)
+            log.append('cadmus-batch-page: {} {}'
+                       .format(match.group(1), pages))
+            pages += figure.count('\\newpage') + 1
+    else:
+        pages = source.count('\\newpage') + 1
+
+    # Request another pass unless the auxiliary file exists, like a document
+    # with cross-references would.
+    if not os.path.exists(name + '.aux'):
+        log.append('LaTeX Warning: Label(s) may have changed. Rerun to get '
+                   'cross-references right.')
+    with open(name + '.aux', 'w') as f:
+        f.write('\\relax\n')
+    with open(name + '.log', 'w') as f:
+        f.write('\n'.join(log) + '\n')
+
+    if '-recorder' in args:
+        with open(name + '.fls', 'w') as f:
+            f.write('PWD ' + os.getcwd() + '\nINPUT ' + file + '\n'
+                    'OUTPUT ' + name + '.log\n')
+    if '--draftmode' not in args:
+        write_pdf(name + '.pdf', pages)
+    print('\n'.join(log))
+    return 0
+
+
+def gs(args):
+    if '--version' in args:
+        print('0.00')
+        return 0
+
+    sleep('gs')
+    options = {}
+    for a in args:
+        if a.startswith('-s') or a.startswith('-d'):
+            (key, _, value) = a[2:].partition('=')
+            options[key] = value
+
+    pages = read_page_count(args[-1])
+    first = int(options.get('FirstPage', 1))
+    last = min(int(options.get('LastPage', pages)), pages)
+    if first > last:
+        print('No pages to process.')
+        return 1
+
+    if options['DEVICE'] == 'bbox':
+        for page in range(first, last + 1):
+            sys.stderr.write('%%BoundingBox: 72 600 288 720\n'
+                             '%%HiResBoundingBox: 72.12 600.50 287.90 '
+                             '719.75\n')
+        return 0
+
+    if '-o' in args:
+        output_path = args[args.index('-o') + 1]
+    else:
+        output_path = options['OutputFile']
+
+    if options['DEVICE'] != 'pdfwrite':
+        write_image(output_path)
+    elif 'DEVICEWIDTHPOINTS' in options:
+        write_pdf(output_path, last - first + 1,
+                  (float(options['DEVICEWIDTHPOINTS']),
+                   float(options['DEVICEHEIGHTPOINTS'])))
+    else:
+        write_pdf(output_path, last - first + 1)
+    return 0
+
+
+def pdftoppm(args):
+    if '-v' in args:
+        sys.stderr.write('pdftoppm version 0.0.0 (cadmus stub)\n')
+        return 0
+
+    sleep('pdftoppm')
+    read_page_count(args[-2])
+    write_image(args[-1] + '.png')
+    return 0
+
+
+def convert(args):
+    if '-version' in args:
+        print('Version: ImageMagick 0.0.0 (cadmus stub)')
+        return 0
+
+    sleep('convert')
+    if args[-2].endswith('.pdf'):
+        read_page_count(args[-2])
+    write_image(args[-1])
+    return 0
+
+
+TOOLS = {
+    'lualatex': lualatex,
+    'gs': gs,
+    'pdftoppm': pdftoppm,
+    'convert': convert
+}
+
+
+if __name__ == '__main__':
+    sys.exit(TOOLS[sys.argv[1]](sys.argv[2:]))
@@ -30,6 +30,12 @@ parser.add_argument('--rst-cs-subsection-char',
                          'sequence subsections.',
                     default='^')
 
+parser.add_argument('--watch',
+                    help='Keep watching the source tree after generating the '
+                         'documents and regenerate the documents of each '
+                         'changed file.',
+                    action='store_true')
+
 args = parser.parse_args()
 
 # Construct RST configuration dict
@@ -40,4 +46,4 @@ rst_conf = {
 }
 
 generate(args.source_root_dir, args.output_root_dir, args.output_dir,
-         args.output_dirs_from_filenames, rst_conf)
+         args.output_dirs_from_filenames, rst_conf, args.watch)
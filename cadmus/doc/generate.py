@@ -1,43 +1,94 @@
 from .file import File
+from ..watch import Watcher
 import os
 
+# File types parsed for documentation.
+SOURCE_FILE_TYPES = ['sty', 'tex', 'cls']
+
+
+def generate_file(root_dir, full_filename, source_root_dir, output_root_dir,
+                  output_dir, output_dirs_from_filenames, rst_conf):
+    (filename, file_type) = full_filename.split('.')
+    # Skip unsupported file types
+    if file_type not in SOURCE_FILE_TYPES:
+        return
+
+    # Replicate hierarchical structure in the output directory
+    local_output_dir = root_dir.split(source_root_dir)[1]
+    if os.name == 'nt':
+        local_output_dir = local_output_dir.strip('\\')
+    else:
+        local_output_dir = local_output_dir.strip('/')
+
+    # Optionally append a directory with the same name as the source
+    # file to the local output directory.
+    if output_dirs_from_filenames:
+        local_output_dir = os.path.join(local_output_dir, filename)
+
+    local_output_dir = os.path.join(output_root_dir, local_output_dir,
+                                    output_dir)
+
+    if not os.path.exists(local_output_dir):
+        print('Creating directory ' + local_output_dir + '.')
+        os.makedirs(local_output_dir)
+
+    # Create file object
+    f = File(os.path.join(root_dir, full_filename))
+    # Generate RST reference documentation for defined macros.
+    f.generate_rst('allsplit', local_output_dir, rst_conf)
+    f.generate_rst('all', local_output_dir, rst_conf)
+    return
+
 
 def generate(source_root_dir, output_root_dir, output_dir,
-             output_dirs_from_filenames, rst_conf):
+             output_dirs_from_filenames, rst_conf, watch=False):
     print('*** Cadmus documentation generator ***')
     print('Begin generating reStructuredText documents.')
     for (root_dir, dir_names, filenames) in os.walk(source_root_dir):
         for full_filename in filenames:
-            (filename, file_type) = full_filename.split('.')
-            # Skip unsupported file types
-            if (file_type != 'sty') and \
-               (file_type != 'tex') and \
-               (file_type != 'cls'):
-                continue
-
-            # Replicate hierarchical structure in the output directory
-            local_output_dir = root_dir.split(source_root_dir)[1]
-            if os.name == 'nt':
-                local_output_dir = local_output_dir.strip('\\')
-            else:
-                local_output_dir = local_output_dir.strip('/')
-
-            # Optionally append a directory with the same name as the source
-            # file to the local output directory.
-            if output_dirs_from_filenames:
-                local_output_dir = os.path.join(local_output_dir, filename)
-
-            local_output_dir = os.path.join(output_root_dir, local_output_dir,
-                                            output_dir)
-
-            if not os.path.exists(local_output_dir):
-                print('Creating directory ' + local_output_dir + '.')
-                os.makedirs(local_output_dir)
-
-            # Create file object
-            f = File(os.path.join(root_dir, full_filename))
-            # Generate RST reference documentation for defined macros.
-            f.generate_rst('allsplit', local_output_dir, rst_conf)
-            f.generate_rst('all', local_output_dir, rst_conf)
+            generate_file(root_dir, full_filename, source_root_dir,
+                          output_root_dir, output_dir,
+                          output_dirs_from_filenames, rst_conf)
 
     print('Done generating reStructuredText documents.\n')
+
+    if watch:
+        watch_sources(source_root_dir, output_root_dir, output_dir,
+                      output_dirs_from_filenames, rst_conf)
+
+
+def watch_sources(source_root_dir, output_root_dir, output_dir,
+                  output_dirs_from_filenames, rst_conf):
+    # Regenerate the documents of each source file as it changes until
+    # interrupted.
+    def is_source(path):
+        return os.path.splitext(path)[1][1:] in SOURCE_FILE_TYPES
+
+    watcher = Watcher([source_root_dir], path_filter=is_source)
+    print('Watching \'' + source_root_dir + '\' for changes (press Ctrl+C '
+          'to stop).')
+    try:
+        while True:
+            for path in sorted(watcher.wait()):
+                if not os.path.exists(path):
+                    print('Removed: ' + path + ', keeping its documents.')
+                    continue
+
+                print('Changed: ' + path)
+                # The watcher uses absolute paths, so the source root
+                # directory has to be absolute as well to replicate the
+                # hierarchical structure.
+                try:
+                    generate_file(os.path.dirname(path),
+                                  os.path.basename(path),
+                                  os.path.abspath(source_root_dir),
+                                  output_root_dir, output_dir,
+                                  output_dirs_from_filenames, rst_conf)
+                except ValueError as e:
+                    print('ERROR: ' + str(e))
+            print('Watching \'' + source_root_dir + '\' for changes.')
+    except KeyboardInterrupt:
+        print('Stopped watching.')
+    finally:
+        watcher.stop()
+    return
@@ -1 +1,2 @@
 from .generate import generate
+from .async_build import build_figures
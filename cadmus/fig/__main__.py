@@ -1,5 +1,9 @@
 import argparse
+import os
 from .generate import generate
+from .build_utils import get_default_scratch_dir
+from .store import (STORE_DIR_VARIABLE, STORE_SIZE_VARIABLE,
+                    DEFAULT_STORE_SIZE, parse_size)
 
 parser = argparse.ArgumentParser(description='Cadmus figure generator.')
 
@@ -41,6 +45,120 @@ parser.add_argument('--dry-run',
                          'skipping the build step.',
                     action='store_true')
 
+parser.add_argument('--jobs', '-j',
+                    help='Specify the number of targets to build in parallel. '
+                         'Defaults to the number of CPUs.',
+                    type=int,
+                    default=os.cpu_count() or 1)
+
+parser.add_argument('--force',
+                    help='Rebuild every target, ignoring the build cache.',
+                    action='store_true')
+
+parser.add_argument('--explain',
+                    help='Print the reason why each target is rebuilt.',
+                    action='store_true')
+
+parser.add_argument('--adaptive-passes',
+                    help='Treat the number of passes as a maximum and stop '
+                         'when LaTeX no longer requests another pass.',
+                    action='store_true')
+
+parser.add_argument('--precompile-preamble',
+                    help='Dump a format once per distinct template and font '
+                         'preamble and compile the figures against it.',
+                    action='store_true')
+
+parser.add_argument('--batch',
+                    help='Compile figures sharing the same preamble in one '
+                         'document with one figure per page.',
+                    action='store_true')
+
+parser.add_argument('--batch-size',
+                    help='Specify the maximum number of figures per batch.',
+                    type=int,
+                    default=20)
+
+parser.add_argument('--trace',
+                    help='Write a timeline of the build to the specified file '
+                         'in the Chrome trace event format.',
+                    default=None)
+
+parser.add_argument('--raster-backend',
+                    help='Specify the rasterization backend. The \'gs\' and '
+                         '\'pdftoppm\' backends render the page at the '
+                         'density which yields the output width while '
+                         '\'convert\' renders at a fixed density and '
+                         'resizes the result. The \'inprocess\' backend '
+                         'renders using PyMuPDF or pypdfium2, if installed, '
+                         'without starting any processes.',
+                    choices=['convert', 'gs', 'pdftoppm', 'inprocess'],
+                    default='convert')
+
+parser.add_argument('--supersample',
+                    help='Specify the factor by which the \'gs\' and '
+                         '\'pdftoppm\' backends render above the output '
+                         'resolution before resizing.',
+                    type=float,
+                    default=2)
+
+parser.add_argument('--watch',
+                    help='Keep watching the source tree after the build and '
+                         'rebuild the targets affected by each change.',
+                    action='store_true')
+
+parser.add_argument('--cache-dir',
+                    help='Specify a directory in which to share compiled '
+                         'documents and images between build trees, e.g. '
+                         'several worktrees or CI jobs on the same machine. '
+                         'To share it between users, make it writable by a '
+                         'common group with the setgid bit set and build '
+                         'with a umask of 002. '
+                         'Defaults to the value of the environment variable '
+                         '{}, if set.'.format(STORE_DIR_VARIABLE),
+                    default=os.environ.get(STORE_DIR_VARIABLE))
+
+parser.add_argument('--cache-size',
+                    help='Specify the size limit of the cache directory, e.g. '
+                         '\'500M\' or \'10G\'. The least recently used '
+                         'files are removed when exceeded. Defaults to the '
+                         'value of the environment variable {}, if set, or '
+                         '{}.'.format(STORE_SIZE_VARIABLE, DEFAULT_STORE_SIZE),
+                    type=parse_size,
+                    default=os.environ.get(STORE_SIZE_VARIABLE,
+                                           DEFAULT_STORE_SIZE))
+
+parser.add_argument('--scratch-dir',
+                    help='Compile and rasterize each figure in a temporary '
+                         'directory below the specified directory, copying '
+                         'only the final PDF and images to the build and '
+                         'output directories. Without a directory, a file '
+                         'system in RAM is used if available. The temporary '
+                         'directory of a figure which fails to build is kept '
+                         'for debugging.',
+                    nargs='?',
+                    const=get_default_scratch_dir(),
+                    default=None)
+
+parser.add_argument('--max-memory',
+                    help='Specify the amount of memory available for '
+                         'rasterizing figures in parallel, e.g. \'8G\'. Each '
+                         'figure waits until its estimated memory use fits '
+                         'and imagemagick is limited to the memory reserved, '
+                         'spilling to disk once exceeded. Compilation is not '
+                         'limited.',
+                    type=parse_size,
+                    default=None)
+
+parser.add_argument('--optimize',
+                    help='Optimize the images once rasterized, losslessly '
+                         'recompressing PNG images with optipng and making '
+                         'JPEG images progressive with jpegtran. The JPEG '
+                         'quality is set per figure with the \'quality\' '
+                         'setting. Optimized images are cached like the '
+                         'other stages.',
+                    action='store_true')
+
 # Parse input arguments
 args = parser.parse_args()
 
@@ -51,4 +169,8 @@ if not args.output_root_dir:
 
 generate(args.source_root_dir, args.build_root_dir, args.output_root_dir,
          args.template, args.font, args.format, args.dev, args.verbose,
-         args.dry_run)
+         args.dry_run, args.jobs, not args.force, args.explain,
+         args.adaptive_passes, args.precompile_preamble, args.batch,
+         args.batch_size, args.trace, args.raster_backend, args.supersample,
+         args.watch, args.cache_dir, args.cache_size, args.scratch_dir,
+         args.max_memory, args.optimize)
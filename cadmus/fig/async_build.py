@@ -0,0 +1,114 @@
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from .src_utils import generate_source_files
+from .build_utils import (ProcessGroup, BuildCancelled, run_in_process_group,
+                          collect_targets, prepare_formats, prepare_batches,
+                          build_targets, get_toolchain_versions,
+                          check_raster_backend, check_optimizers, get_store,
+                          print_summary)
+from .cache import BuildCache
+from .memory import MemoryBudget
+
+
+async def build_figures(source_root_dir, build_root_dir, output_root_dir=None,
+                        default_template='article', default_font=None,
+                        dev=False, jobs=None, use_cache=True, adaptive=False,
+                        precompile_preamble=False, batch=False, batch_size=20,
+                        raster_backend='convert', supersample=2,
+                        progress=None, cache_dir=None, cache_size=None,
+                        scratch_dir=None, max_memory=None, optimize=False):
+    # Asynchronous counterpart to generate(). At most 'jobs' targets are built
+    # concurrently by a pool of worker threads, keeping the event loop free.
+    # The progress callback, if given, is called from the event loop with an
+    # event dict for every stage of every target, e.g.
+    #   {'target': 'dir/name.tex', 'stage': 'compile', 'status': 'started'}
+    # where the stage is one of 'compile', 'raster', 'optimize' or 'target'.
+    # The console output of the pipeline is passed to the callback as events
+    # of the form {'message': 'Summary: 3 succeeded, 0 failed.'} rather than
+    # printed, and dropped if no callback is given.
+    #
+    # If the coroutine is cancelled, every running lualatex, gs or convert
+    # process is terminated and no new processes are started.
+    #
+    # Returns a dict mapping each target to True if it was built
+    # successfully.
+    loop = asyncio.get_running_loop()
+    if not output_root_dir:
+        output_root_dir = source_root_dir
+    if not jobs:
+        jobs = os.cpu_count() or 1
+    check_raster_backend(raster_backend)
+    if optimize:
+        check_optimizers()
+
+    def post(target, stage, status):
+        # Called from the worker threads.
+        if progress:
+            loop.call_soon_threadsafe(progress, {
+                'target': target['id'],
+                'stage': stage,
+                'status': status
+            })
+
+    def output(message):
+        # Called from the worker threads.
+        if progress:
+            loop.call_soon_threadsafe(progress, {'message': message})
+
+    group = ProcessGroup(output)
+    executor = ThreadPoolExecutor(max_workers=1)
+    cache = None
+    store = None
+    memory = MemoryBudget(max_memory) if max_memory else None
+
+    def call(func, *args):
+        # Run the function in a worker thread as part of the build.
+        return loop.run_in_executor(executor, run_in_process_group, group,
+                                    func, *args)
+
+    try:
+        # Generate the source files and collect the targets.
+        delta = await call(generate_source_files, source_root_dir,
+                           build_root_dir, default_template, default_font,
+                           precompile_preamble)
+        if not os.path.exists(output_root_dir):
+            os.makedirs(output_root_dir)
+        targets = await call(collect_targets, build_root_dir,
+                             output_root_dir, delta['orphaned'])
+        await call(prepare_formats, targets, jobs)
+
+        if use_cache:
+            cache = await call(BuildCache, build_root_dir)
+            toolchain = await call(get_toolchain_versions)
+            store = await call(get_store, cache_dir, cache_size)
+        else:
+            toolchain = None
+
+        batches = await call(prepare_batches, targets, build_root_dir,
+                             cache, toolchain, False, batch_size, jobs,
+                             store) if batch else []
+
+        # The stages of the targets are scheduled by build_targets(), running
+        # at most 'jobs' stages at a time on worker threads of its own.
+        results = await call(build_targets, targets, batches, jobs, dev,
+                             False, cache, toolchain, False, adaptive,
+                             raster_backend, supersample, store, scratch_dir,
+                             memory, optimize, post, group)
+        await call(print_summary, targets, results)
+    except (asyncio.CancelledError, BuildCancelled):
+        # Terminate the running processes. The worker threads return as soon
+        # as their current process has exited.
+        group.cancel()
+        raise
+    finally:
+        # Saving the cache and walking the store may take a while, keep the
+        # event loop free in the meantime.
+        if cache:
+            await call(cache.save)
+        if store:
+            await call(store.evict)
+        executor.shutdown(wait=False)
+
+    return {t['id']: r for (t, r) in zip(targets, results)}
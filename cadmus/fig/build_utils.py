@@ -1,17 +1,479 @@
 import os
-import json
-from subprocess import Popen, DEVNULL
+import re
+import sys
+import math
+import zlib
+import shutil
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen, PIPE, DEVNULL, STDOUT
 
-from .common import CFG_FILE_NAME
+from .common import (LOG_FILE_NAME, BATCH_DIR_NAME, write_if_changed,
+                     copy_file, echo, set_output)
+from .cache import BuildCache, hash_file
+from .tracing import span
+from .render import get_renderer, get_renderer_version, render_image
+from .manifest import read_manifest
+from .store import ArtifactStore, DEFAULT_STORE_SIZE, get_key, parse_size
+from .memory import MemoryBudget, estimate_memory, MEASURED_MARGIN
+from .tasks import TaskGraph
 
 
-def generate_pdf(file, output_dir, page, passes, crop, crop_margins, verbose):
+class BuildCancelled(Exception):
+    def __init__(self, message='The build was cancelled.'):
+        super(BuildCancelled, self).__init__(message)
+        return
+
+
+class ProcessGroup:
+    # Locals
+    processes_ = None  # The external processes started on behalf of a build
+    cancelled_ = False
+    lock_ = None
+    output_ = None  # Receives the console output of the build, if given
+
+    # Constructor
+    def __init__(self, output=None):
+        self.processes_ = []
+        self.cancelled_ = False
+        self.lock_ = threading.Lock()
+        self.output_ = output
+        return
+
+    def popen(self, *args, **kwargs):
+        # Start a process as a member of the group. No new processes may be
+        # started once the group has been cancelled.
+        with self.lock_:
+            if self.cancelled_:
+                raise BuildCancelled()
+            p = Popen(*args, **kwargs)
+            self.processes_.append(p)
+        return p
+
+    def cancel(self):
+        # Terminate every process in the group which is still running.
+        with self.lock_:
+            self.cancelled_ = True
+            for p in self.processes_:
+                if p.poll() is None:
+                    p.terminate()
+        return
+
+
+# The process group of the build running in the current thread, if any.
+_context = threading.local()
+
+
+def _popen(*args, **kwargs):
+    group = getattr(_context, 'group', None)
+    if group:
+        return group.popen(*args, **kwargs)
+    return Popen(*args, **kwargs)
+
+
+def run_in_process_group(group, func, *args):
+    # Call the function, starting any external processes as members of the
+    # process group and passing the console output to the output function of
+    # the group, if any. Intended to be run in a worker thread.
+    previous = getattr(_context, 'group', None)
+    _context.group = group
+    previous_output = set_output(group.output_ if group else None)
+    try:
+        return func(*args)
+    finally:
+        _context.group = previous
+        set_output(previous_output)
+
+
+def _wait(p):
+    # Wait for the process to exit and return its exit status. The peak
+    # memory use of the process is recorded for the calling thread if the
+    # platform reports it.
+    if not hasattr(os, 'wait4'):
+        return p.wait()
+    try:
+        (pid, status, usage) = os.wait4(p.pid, 0)
+    except ChildProcessError:
+        # Already reaped, e.g. while the build was being cancelled.
+        return p.wait()
+    p.returncode = os.waitstatus_to_exitcode(status)
+
+    peaks = getattr(_context, 'peaks', None)
+    if peaks is not None:
+        # Reported in bytes on macOS and in kilobytes elsewhere.
+        peaks.append(usage.ru_maxrss *
+                     (1 if sys.platform == 'darwin' else 1024))
+    return p.returncode
+
+
+def _log(log, message):
+    # Flush after writing since the subprocesses write to the same file
+    # descriptor directly.
+    log.write(message + '\n')
+    log.flush()
+
+
+def get_convert_cmd():
+    if os.name == 'nt':
+        return r'C:\cygwin\bin\convert'
+    else:
+        return 'convert'
+
+
+def get_density(dev):
+    return '200' if dev else '1500'
+
+
+# Backends rendering the PDF page at the resolution of the output image. The
+# 'convert' backend renders at a fixed density and resizes the result and the
+# 'inprocess' backend renders using a PDF library, if one is installed.
+RASTER_BACKENDS = ['convert', 'gs', 'pdftoppm', 'inprocess']
+
+# Supported image formats.
+RASTER_FORMATS = ['jpg', 'png', 'webp', 'avif']
+
+# Formats published without rasterizing the page. SVG images are converted
+# from the PDF by dvisvgm, which ships with TeX Live, and PDF files are the
+# cropped PDF itself.
+VECTOR_FORMATS = ['svg', 'pdf']
+
+# The handling of the fonts of SVG images, either converting the glyphs to
+# paths or embedding the fonts.
+SVG_FONTS = ['paths', 'embed']
+
+
+def get_raster_backend(backend):
+    # Fall back to imagemagick if in-process rendering is requested but no
+    # PDF library is installed.
+    if backend == 'inprocess' and not get_renderer():
+        return 'convert'
+    return backend
+
+
+def is_rendered_inprocess(backend, outputs):
+    # A single JPEG or PNG image is rendered in-process by the 'inprocess'
+    # backend. Otherwise, the page is rendered above the output resolution
+    # and the images are derived using imagemagick, see rasterize().
+    return get_raster_backend(backend) == 'inprocess' and \
+        len(outputs) == 1 and outputs[0][0] in ['jpg', 'png']
+
+
+def check_raster_backend(backend):
+    if get_raster_backend(backend) != backend:
+        echo('WARNING: No PDF library is installed for in-process '
+             'rasterization (PyMuPDF or pypdfium2), falling back to '
+             'imagemagick.')
+    return
+
+
+def get_supersample(dev, supersample):
+    # Developer mode renders at the output resolution.
+    return 1 if dev else supersample
+
+
+def get_tool_version(cmd, stderr=DEVNULL):
+    # Return the first line printed by the tool when asked for its version, or
+    # None if the tool could not be run.
+    try:
+        p = Popen(cmd, stdout=PIPE, stderr=stderr, universal_newlines=True)
+        (out, err) = p.communicate()
+    except OSError:
+        return None
+    lines = out.strip().splitlines()
+    return lines[0] if lines else None
+
+
+def get_tex_dirs():
+    # Return the directories of the TeX distribution and its caches. Files
+    # read from these are not tracked as dependencies of the targets, updates
+    # to the distribution are covered by the version of lualatex instead.
+    dirs = []
+    for var in ['TEXMFROOT', 'TEXMFDIST', 'TEXMFMAIN', 'TEXMFLOCAL',
+                'TEXMFSYSVAR', 'TEXMFSYSCONFIG', 'TEXMFVAR', 'TEXMFCONFIG',
+                'TEXMFCACHE']:
+        value = get_tool_version(['kpsewhich', '-var-value=' + var])
+        if value:
+            dirs += [os.path.abspath(os.path.expanduser(d))
+                     for d in value.split(os.pathsep) if d]
+    return sorted(set(dirs))
+
+
+def get_toolchain_versions():
+    return {
+        'tex_dirs': get_tex_dirs(),
+        'lualatex': get_tool_version(['lualatex', '--version']),
+        'gs': get_tool_version(['gs', '--version']),
+        'convert': get_tool_version([get_convert_cmd(), '-version']),
+        'pdftoppm': get_tool_version(['pdftoppm', '-v'], stderr=STDOUT),
+        'dvisvgm': get_tool_version(['dvisvgm', '--version']),
+        'inprocess': get_renderer_version(),
+        'optipng': get_tool_version(['optipng', '-v']),
+        'jpegtran': get_tool_version(['jpegtran', '-version'], stderr=STDOUT)
+    }
+
+
+def get_compile_key(target, toolchain, cache):
+    # Everything that affects the PDF produced by generate_pdf(), including
+    # the files lualatex read during the last build of the target, e.g. data
+    # files read with \input or images included with \includegraphics.
+    match = target['match']
+    dependencies = match.get('dependencies', [match.get('template')])
+    return {
+        'source': hash_file(target['file']),
+        'template': {d: hash_file(d) for d in dependencies if d},
+        'settings': {k: match.get(k) for k in
+                     ['page', 'passes', 'crop', 'crop_margins', 'font']},
+        'inputs': {p: hash_file(p) for p in cache.get_inputs(target['id'])},
+        'toolchain': {k: toolchain[k] for k in ['lualatex', 'gs']}
+    }
+
+
+def get_recorded_inputs(fls_file, exclude_dirs):
+    # Return the files read by lualatex according to the recorder file
+    # written by the -recorder option, leaving out any files in the excluded
+    # directories, e.g. the TeX distribution and the build directory.
+    try:
+        with open(fls_file, errors='replace') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return []
+
+    cwd = os.path.dirname(os.path.abspath(fls_file))
+    inputs = set()
+    for line in lines:
+        if line.startswith('PWD '):
+            cwd = line[4:]
+        elif line.startswith('INPUT '):
+            path = os.path.normpath(os.path.join(cwd, line[6:]))
+            if any(path == d or path.startswith(d + os.sep)
+                   for d in exclude_dirs):
+                continue
+            if os.path.isfile(path):
+                inputs.add(path)
+    return sorted(inputs)
+
+
+def record_inputs(target, compile_key, toolchain, work_dir=None):
+    # Add the files read while compiling the target to the compile key. The
+    # recorder file is written to the directory lualatex was run in, i.e.
+    # the batch directory if the target was compiled in a batch or the
+    # scratch directory if given. Files in the build tree are left out.
+    file_name = os.path.splitext(os.path.basename(target['file']))[0]
+    fls_file = target.get('recorder', os.path.join(
+        work_dir or os.path.dirname(target['file']), file_name + '.fls'))
+    exclude_dirs = toolchain['tex_dirs'] + [
+        os.path.dirname(os.path.abspath(fls_file)),
+        os.path.dirname(os.path.abspath(target['file']))
+    ]
+    if target.get('preamble_format'):
+        exclude_dirs.append(os.path.dirname(target['preamble_format']))
+    compile_key['inputs'] = {p: hash_file(p) for p in
+                             get_recorded_inputs(fls_file, exclude_dirs)}
+    return
+
+
+def get_raster_key(pdf_file, output_format, dev, toolchain, width=1000,
+                   backend='convert', supersample=2, quality=None,
+                   svg_fonts='paths'):
+    # Everything that affects the image produced by rasterize().
+    backend = get_raster_backend(backend)
+    formats = [f.lower() for f in output_format] \
+        if isinstance(output_format, list) else output_format.lower()
+    key = {
+        'pdf': hash_file(pdf_file),
+        'format': formats,
+        'width': width,
+        'backend': backend,
+        'toolchain': {'convert': toolchain['convert']}
+    }
+    if backend == 'convert':
+        key['density'] = get_density(dev)
+    elif backend == 'inprocess':
+        key['toolchain'] = {'inprocess': toolchain['inprocess']}
+        outputs = get_raster_only(get_raster_outputs('', '', output_format,
+                                                     width))
+        if not is_rendered_inprocess(backend, outputs):
+            key['supersample'] = get_supersample(dev, supersample)
+            key['toolchain']['convert'] = toolchain['convert']
+    else:
+        key['supersample'] = get_supersample(dev, supersample)
+        key['toolchain'][backend] = toolchain[backend]
+    if quality is not None:
+        key['quality'] = quality
+    if 'svg' in formats:
+        key['toolchain']['dvisvgm'] = toolchain['dvisvgm']
+        key['svg_fonts'] = svg_fonts
+    return key
+
+
+# Messages in the LaTeX log requesting another pass.
+RERUN_PATTERN = re.compile(
+    r'(Rerun to get|Please rerun|Please \(re\)run|Rerun LaTeX|'
+    r'Label\(s\) may have changed|has changed\.\s*Rerun)',
+    re.IGNORECASE
+)
+
+
+def needs_rerun(log_path):
+    try:
+        with open(log_path, errors='replace') as f:
+            return RERUN_PATTERN.search(f.read()) is not None
+    except OSError:
+        return False
+
+
+def call_lualatex(file, output_dir, draft, log, preamble_format=None):
+    # Record the files read by lualatex in '<file_name>.fls'.
+    cmd = ['lualatex', '-recorder']
+    env = None
+    if draft:
+        # Skip writing the PDF for passes which only update auxiliary files.
+        cmd.append('--draftmode')
+    if preamble_format:
+        # Load the precompiled format, prepending its directory to the format
+        # search path.
+        cmd.append('--fmt=' + os.path.basename(preamble_format))
+        env = dict(os.environ)
+        env['TEXFORMATS'] = (os.path.dirname(preamble_format) + os.pathsep +
+                             env.get('TEXFORMATS', ''))
+    cmd.append(os.path.abspath(file))
+
+    with span('lualatex: ' + os.path.basename(file), 'compile',
+              file=file, draft=draft,
+              preamble_format=preamble_format) as s:
+        p_latex = _popen(
+            cmd,
+            cwd=os.path.abspath(output_dir),
+            env=env,
+            stdout=log,
+            stderr=STDOUT
+        )
+        p_latex.wait()
+        s['exit_status'] = p_latex.returncode
+    return p_latex.returncode
+
+
+def run_lualatex(file, output_dir, passes, log, preamble_format=None):
+    # Call lualatex a fixed number of times.
+    for p in range(passes):
+        _log(log, 'Pass {} of {}.'.format(p+1, passes))
+        returncode = call_lualatex(file, output_dir, False, log,
+                                   preamble_format)
+
+    return returncode
+
+
+def run_lualatex_adaptive(file, output_dir, passes, log,
+                          preamble_format=None):
+    # Call lualatex until the log no longer requests another pass, treating
+    # passes as the maximum number of passes. Passes which are known not to be
+    # the final pass run in draft mode. The auxiliary files from the previous
+    # build are kept in the output directory. If they exist, an unchanged
+    # document converges in the first pass, so that pass is run normally.
+    (file_name, file_type) = os.path.basename(file).split('.')
+    log_path = os.path.join(output_dir, file_name + '.log')
+    aux_path = os.path.join(output_dir, file_name + '.aux')
+
+    draft = (passes > 1) and not os.path.exists(aux_path)
+    p = 0
+    while p < passes:
+        p += 1
+        _log(log, 'Pass {} of at most {}{}.'
+                  .format(p, passes, ' (draft)' if draft else ''))
+        returncode = call_lualatex(file, output_dir, draft, log,
+                                   preamble_format)
+        if returncode != 0:
+            return returncode
+
+        rerun = needs_rerun(log_path)
+        if not draft and not rerun:
+            return 0
+
+        # Either the document has not converged or the PDF has not been
+        # written yet. Keep using draft mode until the last allowed pass.
+        draft = rerun and (p + 1 < passes)
+
+    _log(log, 'WARNING: Document did not converge in {} passes.'
+              .format(passes))
+    return 0
+
+
+def generate_format(preamble_format, version, log):
+    # Dump a format from the preamble document '<preamble_format>.tex' using
+    # mylatexformat. The format is kept if it has already been dumped by the
+    # same version of lualatex. Returns True if the format is available.
+    format_dir = os.path.dirname(preamble_format)
+    name = os.path.basename(preamble_format)
+    version_path = preamble_format + '.version'
+
+    if os.path.exists(preamble_format + '.fmt'):
+        try:
+            with open(version_path) as f:
+                if f.read() == str(version):
+                    return True
+        except OSError:
+            pass
+
+    _log(log, 'Dumping format \'' + name + '.fmt\'.')
+    with span('dump format: ' + name, 'format', file=preamble_format) as s:
+        p_latex = _popen(
+            ['lualatex',
+             '-ini',
+             '-jobname=' + name,
+             '&lualatex',
+             'mylatexformat.ltx',
+             name + '.tex'],
+            cwd=os.path.abspath(format_dir),
+            stdout=log,
+            stderr=STDOUT
+        )
+        p_latex.wait()
+        s['exit_status'] = p_latex.returncode
+
+    if p_latex.returncode != 0 or \
+       not os.path.exists(preamble_format + '.fmt'):
+        return False
+
+    with open(version_path, 'w') as f:
+        f.write(str(version))
+    return True
+
+
+def generate_formats(preamble_formats, jobs):
+    # Dump every distinct format in parallel. Returns the set of formats which
+    # are available to the targets. The processes are started in the process
+    # group of the calling thread, if any, so that they're terminated if the
+    # build is cancelled.
+    version = get_tool_version(['lualatex', '--version'])
+    group = getattr(_context, 'group', None)
+
+    def dump(preamble_format):
+        with open(preamble_format + '_' + LOG_FILE_NAME, 'w') as log:
+            return run_in_process_group(group, generate_format,
+                                        preamble_format, version, log)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(dump, preamble_formats))
+
+    available = set()
+    for (preamble_format, result) in zip(preamble_formats, results):
+        if result:
+            available.add(preamble_format)
+        else:
+            echo('WARNING: Failed to dump format \'' + preamble_format +
+                 '.fmt\', compiling without it (see \'' + preamble_format +
+                 '_' + LOG_FILE_NAME + '\').')
+    return available
+
+
+def generate_pdf(file, output_dir, page, passes, crop, crop_margins, log,
+                 adaptive=False, preamble_format=None):
     # Check if file exists
     if not os.path.exists(file):
         raise ValueError('File \'' + file + '\' does not exist.')
 
-    ostream = None if verbose else DEVNULL
-
     # Find out some information about the input file
     (file_name, file_type) = os.path.basename(file).split('.')
 
@@ -25,83 +487,419 @@ def generate_pdf(file, output_dir, page, passes, crop, crop_margins, verbose):
                          .format(file_type))
 
     # Call lualatex
-    for p in range(passes):
-        print('Pass {} of {}.'.format(p+1, passes))
-        p_latex = Popen(
-            ['lualatex', os.path.abspath(file)],
-            cwd=os.path.abspath(output_dir),
-            stdout=ostream,
-            stderr=ostream
+    if adaptive:
+        returncode = run_lualatex_adaptive(file, output_dir, passes, log,
+                                           preamble_format)
+    else:
+        returncode = run_lualatex(file, output_dir, passes, log,
+                                  preamble_format)
+
+    if returncode != 0:
+        return returncode
+
+    # Extract the target page, cropping it if requested.
+    pdf_file = os.path.join(output_dir, file_name + '.pdf')
+    return extract_page(pdf_file, pdf_file, page, crop, crop_margins, log)
+
+
+def parse_crop_margins(crop_margins):
+    # Parse the margins using the same format as pdfcrop, i.e.
+    # '<left> <top> <right> <bottom>' in bp. A single value is used for all
+    # margins and two values are used for left/right and top/bottom.
+    try:
+        values = [float(v) for v in str(crop_margins).split()]
+    except ValueError:
+        values = []
+
+    if len(values) == 1:
+        values = values * 4
+    elif len(values) == 2:
+        values = values * 2
+    elif len(values) != 4:
+        raise ValueError('Invalid crop margins \'{}\'.'.format(crop_margins))
+
+    return values
+
+
+def get_bounding_box(file, page, log):
+    # Call ghostscript to find the bounding box of the target page. Only the
+    # target page is processed and no output file is written.
+    with span('gs bbox: ' + os.path.basename(file), 'extract', file=file,
+              page=page) as s:
+        p_bbox = _popen(
+            ['gs',
+             '-sDEVICE=bbox',
+             '-dSAFER',
+             '-dBATCH',
+             '-dNOPAUSE',
+             '-dFirstPage=' + str(page),
+             '-dLastPage=' + str(page),
+             os.path.basename(file)],
+            cwd=os.path.dirname(os.path.abspath(file)),
+            stdout=log,
+            stderr=PIPE,
+            universal_newlines=True
         )
-        p_latex.wait()
+        (out, err) = p_bbox.communicate()
+        s['exit_status'] = p_bbox.returncode
+    _log(log, err)
+
+    match = re.search(r'%%HiResBoundingBox:\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)',
+                      err)
+    if p_bbox.returncode != 0 or not match:
+        return None
+
+    return [float(v) for v in match.groups()]
+
+
+def extract_page(source_path, destination_path, page, crop, crop_margins,
+                 log):
+    # Post-process the PDF produced by lualatex. The target page is extracted
+    # and cropped in a single pdfwrite pass with ghostscript, preceded by a
+    # bbox pass measuring the page when cropping is requested. Cropping is
+    # done by fixing the media size to the bounding box (plus margins) and
+    # offsetting the page contents accordingly. The source and destination
+    # may be the same file.
+    source_path = os.path.abspath(source_path)
+    destination_path = os.path.abspath(destination_path)
+    output_dir = os.path.dirname(destination_path)
+    file_name = os.path.splitext(os.path.basename(destination_path))[0]
+    page_path = os.path.join(output_dir, file_name + '_page.pdf')
 
-    if p_latex.returncode > 0:
-        return p_latex.returncode
+    gs_cmd = [
+        'gs',
+        '-sDEVICE=pdfwrite',
+        '-dSAFER',
+        '-dFirstPage=' + str(page),
+        '-dLastPage=' + str(page),
+        '-o', page_path
+    ]
 
-    # Call pdfcrop if crop option is true
     if crop:
-        p_pdfcrop = Popen(
-            ['pdfcrop',
-             '--margins', crop_margins,
-             file_name + '.pdf', file_name + '.pdf'],
-            cwd=os.path.abspath(output_dir),
-            stdout=ostream,
-            stderr=ostream
+        (left, top, right, bottom) = parse_crop_margins(crop_margins)
+        bbox = get_bounding_box(source_path, page, log)
+        if not bbox:
+            _log(log, 'ERROR: Document \'{}\' did not produce the target '
+                      'page ({}).'.format(source_path, page))
+            return -1
+
+        x0 = bbox[0] - left
+        y0 = bbox[1] - bottom
+        x1 = bbox[2] + right
+        y1 = bbox[3] + top
+        gs_cmd += [
+            '-dDEVICEWIDTHPOINTS={:.2f}'.format(x1 - x0),
+            '-dDEVICEHEIGHTPOINTS={:.2f}'.format(y1 - y0),
+            '-dFIXEDMEDIA',
+            '-c', '<</PageOffset [{:.2f} {:.2f}]>> setpagedevice'
+                  .format(-x0, -y0),
+            '-f'
+        ]
+
+    gs_cmd.append(source_path)
+
+    with span('gs extract: ' + os.path.basename(destination_path), 'extract',
+              file=source_path, page=page, crop=crop) as s:
+        p_gs = _popen(
+            gs_cmd,
+            cwd=output_dir,
+            stdout=log,
+            stderr=STDOUT
         )
-        p_pdfcrop.wait()
-
-        if p_pdfcrop.returncode > 0:
-            return p_pdfcrop.returncode
-
-    # Call ghostscript to split pages into separate documents
-    p_gs = Popen(
-        ['gs',
-         '-sDEVICE=pdfwrite',
-         '-dSAFER',
-         '-o', file_name + '_%d.pdf',
-         file_name + '.pdf'],
-        cwd=os.path.abspath(output_dir),
-        stdout=ostream,
-        stderr=ostream
-    )
-    p_gs.wait()
+        p_gs.wait()
+        s['exit_status'] = p_gs.returncode
 
     # Check if the target page exists before moving on
-    source_path = os.path.join(
-        os.path.abspath(output_dir),
-        file_name + '_' + str(page) + '.pdf'
-    )
-    destination_path = os.path.join(
-        os.path.abspath(output_dir),
-        file_name + '.pdf'
-    )
-
-    if not os.path.exists(source_path):
-        print('ERROR: Document \'{}\' did not produce the target page ({}).'
-              .format(destination_path, page))
-        return -1
+    if p_gs.returncode != 0 or not os.path.exists(page_path):
+        _log(log, 'ERROR: Document \'{}\' did not produce the target page '
+                  '({}).'.format(source_path, page))
+        if os.path.exists(page_path):
+            os.remove(page_path)
+        return p_gs.returncode or -1
 
-    # Replace source PDF with the target page PDF
-    os.replace(source_path, destination_path)
+    # Replace the destination PDF with the target page PDF
+    os.replace(page_path, destination_path)
 
-    return p_gs.returncode
+    # Clean up any per-page documents left behind by earlier versions which
+    # split every page into a separate file.
+    for f in os.listdir(output_dir):
+        if re.match(re.escape(file_name) + r'_\d+\.pdf$', f):
+            os.remove(os.path.join(output_dir, f))
 
+    return 0
 
-def rasterize(file, output_dir, output_format, dev, verbose):
-    # Check if file exists
-    if not os.path.exists(file):
-        raise ValueError('File \'' + file + '\' does not exist.')
 
-    output_format = output_format.lower()
+# A media box in a PDF, i.e. '/MediaBox [<x0> <y0> <x1> <y1>]'.
+MEDIA_BOX_PATTERN = re.compile(
+    rb'/MediaBox\s*\[\s*(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s*\]'
+)
+
+
+def get_page_size(file):
+    # Return the width and height in bp of the first media box found in the
+    # PDF, i.e. the size of the single page written by extract_page(). The
+    # page object may be stored in a compressed object stream, in which case
+    # the streams are searched as well. Returns None if no media box is found.
+    with open(file, 'rb') as f:
+        data = f.read()
+
+    match = MEDIA_BOX_PATTERN.search(data)
+    if not match:
+        for stream in re.finditer(rb'stream\r?\n(.*?)endstream', data,
+                                  re.DOTALL):
+            try:
+                match = MEDIA_BOX_PATTERN.search(
+                    zlib.decompressobj().decompress(stream.group(1)))
+            except zlib.error:
+                continue
+            if match:
+                break
+
+    if not match:
+        return None
+
+    try:
+        (x0, y0, x1, y1) = [float(v) for v in match.groups()]
+    except ValueError:
+        return None
+    return (abs(x1 - x0), abs(y1 - y0))
+
+
+def render_page(file, backend, density, log):
+    # Render the PDF page at the given density (dpi) to a PNG image next to
+    # the PDF using ghostscript or pdftoppm. Both render on a white
+    # background. Returns the path to the image or None on failure.
+    input_dir = os.path.dirname(os.path.abspath(file))
+    file_name = os.path.splitext(os.path.basename(file))[0]
+    image_path = os.path.join(input_dir, file_name + '_render.png')
+
+    if backend == 'gs':
+        cmd = [
+            'gs',
+            '-sDEVICE=png16m',
+            '-dSAFER',
+            '-dTextAlphaBits=4',
+            '-dGraphicsAlphaBits=4',
+            '-r{:.2f}'.format(density),
+            '-o', image_path,
+            os.path.basename(file)
+        ]
+    else:
+        # The output file name is given without the file extension.
+        cmd = [
+            'pdftoppm',
+            '-png',
+            '-singlefile',
+            '-r', '{:.2f}'.format(density),
+            os.path.basename(file),
+            os.path.splitext(image_path)[0]
+        ]
+
+    with span(backend + ': ' + file_name, 'raster', file=file,
+              density=density) as s:
+        p_render = _popen(
+            cmd,
+            cwd=input_dir,
+            stdout=log,
+            stderr=STDOUT
+        )
+        _wait(p_render)
+        s['exit_status'] = p_render.returncode
+
+    if p_render.returncode != 0 or not os.path.exists(image_path):
+        _log(log, 'ERROR: Failed to render \'{}\' using {}.'
+                  .format(file, backend))
+        return None
+    return image_path
+
+
+def get_raster_outputs(file_name, output_dir, output_format, width):
+    # Return the images produced for a target as a list of (format, width,
+    # path) tuples. The format and the width may each be given as a list, in
+    # which case an image is produced for every combination. If the width is
+    # a list, it's encoded in the file names, i.e. '<file_name>-<width>w.png'.
+    # A vector format yields a single output without a width, i.e. '<format>,
+    # None, <file_name>.svg'.
+    formats = output_format if isinstance(output_format, list) else \
+        [output_format]
+    widths = width if isinstance(width, list) else [width]
+
+    outputs = []
+    for f in formats:
+        if f.lower() in VECTOR_FORMATS:
+            outputs.append((f.lower(), None, os.path.abspath(
+                os.path.join(output_dir, file_name + '.' + f.lower())
+            )))
+            continue
+        for w in widths:
+            name = file_name
+            if isinstance(width, list):
+                name += '-{}w'.format(w)
+            outputs.append((f.lower(), w, os.path.abspath(
+                os.path.join(output_dir, name + '.' + f.lower())
+            )))
+    return outputs
+
 
-    # Validate output format
-    if (output_format != 'jpg') and \
-       (output_format != 'png'):
-        raise ValueError('Unsupported rasterization format \'{}\'.'
-                         .format(output_format))
+def get_raster_only(outputs):
+    # Return the outputs which have to be rasterized.
+    return [(f, w, p) for (f, w, p) in outputs if f not in VECTOR_FORMATS]
 
-    ostream = None if verbose else DEVNULL
-    density = '200' if dev else '1500'
+
+def get_limit_args(memory_limit):
+    # Limit the memory used by imagemagick for its pixel cache, spilling to a
+    # memory mapped file and then to disk once exceeded.
+    if not memory_limit:
+        return []
+    return ['-limit', 'memory', str(int(memory_limit)),
+            '-limit', 'map', str(int(2 * memory_limit))]
+
+
+# Formats compressed with loss, i.e. to which the image quality applies.
+LOSSY_FORMATS = ['jpg', 'webp', 'avif']
+
+
+def convert_image(input_file, input_dir, output_path, width, density, log,
+                  memory_limit=None, quality=None):
+    # Call convert (imagemagick)
+    # The current working directory has to be the input file directory in order
+    # to work properly. However, the output can be placed in any directory.
+    # The quality, if given, applies to lossy formats.
+    convert_cmd = [get_convert_cmd()] + get_limit_args(memory_limit) + [
+        # Remove alpha layer and replace with a solid background color.
+        '-background', 'white',
+        '-alpha', 'remove', '-alpha', 'off',
+        # Draw a thin border around the image.
+        '-bordercolor', 'gray',
+        '-border', '1'
+    ]
+    if density:
+        # Supersampling instead to preserve color space?
+        convert_cmd += ['-density', density]
+    if quality and os.path.splitext(output_path)[1][1:] in LOSSY_FORMATS:
+        convert_cmd += ['-quality', str(quality)]
+    convert_cmd += [
+        '-resize', '{}x'.format(width),
+        '-flatten',
+        input_file,
+        output_path
+    ]
+
+    with span('convert: ' + os.path.basename(output_path), 'raster',
+              file=input_file, width=width, density=density) as s:
+        p_convert = _popen(
+            convert_cmd,
+            cwd=os.path.abspath(input_dir),
+            stdout=log,
+            stderr=STDOUT
+        )
+        _wait(p_convert)
+        s['exit_status'] = p_convert.returncode
+
+    return p_convert.returncode
+
+
+def convert_vector(file, output_path, log, svg_fonts='paths'):
+    # Publish the PDF in a vector format. The glyphs of an SVG image are
+    # converted to paths, so the image looks the same wherever it's shown,
+    # unless the fonts are to be embedded.
+    if output_path.endswith('.pdf'):
+        if os.path.abspath(file) != os.path.abspath(output_path):
+            copy_file(file, output_path)
+        return 0
+
+    dvisvgm_cmd = ['dvisvgm', '--pdf', '--page=1',
+                   '--output=' + os.path.abspath(output_path)]
+    if svg_fonts == 'paths':
+        dvisvgm_cmd += ['--no-fonts']
+    else:
+        dvisvgm_cmd += ['--font-format=woff2']
+    dvisvgm_cmd += [os.path.basename(file)]
+
+    with span('dvisvgm: ' + os.path.basename(output_path), 'raster',
+              file=file, fonts=svg_fonts) as s:
+        p_dvisvgm = _popen(
+            dvisvgm_cmd,
+            cwd=os.path.abspath(os.path.dirname(file)),
+            stdout=log,
+            stderr=STDOUT
+        )
+        p_dvisvgm.wait()
+        s['exit_status'] = p_dvisvgm.returncode
+
+    return p_dvisvgm.returncode
+
+
+def render_full(file, backend, width, dev, supersample, log,
+                memory_limit=None):
+    # Render the page once, on a white background, at a resolution high
+    # enough for an image of the given width. Returns the path to the
+    # rendering or None on failure.
+    input_dir = os.path.dirname(os.path.abspath(file))
+    file_name = os.path.splitext(os.path.basename(file))[0]
+
+    if backend == 'convert':
+        # Let imagemagick render the page at a fixed density.
+        render_path = os.path.join(input_dir, file_name + '_render.png')
+        with span('convert: ' + file_name, 'raster', file=file,
+                  density=get_density(dev)) as s:
+            p_convert = _popen(
+                [get_convert_cmd()] + get_limit_args(memory_limit) +
+                ['-density', get_density(dev),
+                 os.path.basename(file),
+                 '-background', 'white',
+                 '-alpha', 'remove', '-alpha', 'off',
+                 '-flatten',
+                 render_path],
+                cwd=input_dir,
+                stdout=log,
+                stderr=STDOUT
+            )
+            _wait(p_convert)
+            s['exit_status'] = p_convert.returncode
+        if p_convert.returncode != 0 or not os.path.exists(render_path):
+            _log(log, 'ERROR: Failed to render \'{}\' using convert.'
+                      .format(file))
+            return None
+        return render_path
+
+    width = width * get_supersample(dev, supersample)
+    if backend == 'inprocess':
+        render_path = os.path.join(input_dir, file_name + '_render.png')
+        with span('render: ' + file_name, 'raster', file=file,
+                  renderer=get_renderer()):
+            render_image(file, render_path, 'png', int(round(width)),
+                         border=False)
+        return render_path
+
+    # Render the page at the density which yields the width.
+    size = get_page_size(file)
+    if not size or size[0] <= 0:
+        _log(log, 'ERROR: Failed to read the page size of \'{}\'.'
+                  .format(file))
+        return None
+    return render_page(file, backend, width / (size[0] / 72.0), log)
+
+
+def rasterize(file, output_dir, output_format, dev, log, width=1000,
+              backend='convert', supersample=2, memory_limit=None,
+              quality=None, svg_fonts='paths', slots=None):
+    # Rasterize the PDF to an image in every output format and width. If
+    # several images are requested, the page is rendered once at the
+    # resolution of the widest image and the images are derived from the
+    # rendering in parallel. The vector formats are published first without
+    # rendering the page, see convert_vector().
+    #
+    # The memory used by imagemagick is limited to the given number of bytes
+    # if specified, split evenly between the images derived in parallel. The
+    # quality applies to the lossy formats, defaulting to that of
+    # imagemagick. If a semaphore is given, every image derived holds one of
+    # its slots, bounding the conversions running at a time across the
+    # targets sharing it.
+
+    # Check if file exists
+    if not os.path.exists(file):
+        raise ValueError('File \'' + file + '\' does not exist.')
 
     # Find out some information about the input file
     input_dir = os.path.dirname(file)
@@ -111,191 +909,1178 @@ def rasterize(file, output_dir, output_format, dev, verbose):
     if not output_dir:
         output_dir = input_dir
 
+    outputs = get_raster_outputs(file_name, output_dir, output_format, width)
+
+    # Validate output formats and widths
+    for (f, w, output_path) in outputs:
+        if f in VECTOR_FORMATS:
+            continue
+        if f not in RASTER_FORMATS:
+            raise ValueError('Unsupported rasterization format \'{}\'.'
+                             .format(f))
+        if w < 1:
+            raise ValueError('Invalid image width {}, valid range: > 0.'
+                             .format(w))
+    if not outputs:
+        raise ValueError('No output format or width specified.')
+
+    # Validate backend
+    backend = get_raster_backend(backend)
+    if backend not in RASTER_BACKENDS:
+        raise ValueError('Unsupported rasterization backend \'{}\'.'
+                         .format(backend))
+    if supersample <= 0:
+        raise ValueError('Invalid supersampling factor {}, valid range: > 0.'
+                         .format(supersample))
+
     # Check file type, only PDFs are supported currently although imagemagick
     # would probably be able to handle anything thrown at it.
     if (file_type != 'pdf'):
         raise ValueError('Input file type \'.pdf\' expected, got \'.{}\''
                          .format(file_type))
+    if svg_fonts not in SVG_FONTS:
+        raise ValueError('Unsupported SVG font handling \'{}\'.'
+                         .format(svg_fonts))
 
-    p_touch = Popen(
-        [
-            'touch',
-            os.path.abspath(
-                os.path.join(output_dir, file_name + '.' + output_format)
-            )
-        ],
-    )
-    p_touch.wait()
+    for (f, w, output_path) in outputs:
+        if f in VECTOR_FORMATS:
+            returncode = convert_vector(file, output_path, log, svg_fonts)
+            if returncode != 0:
+                return returncode
+    outputs = get_raster_only(outputs)
+    if not outputs:
+        return 0
 
-    # Call convert (imagemagick)
-    # The current working directory has to be the input file directory in order
-    # to work properly. However, the output can be placed in any directory.
-    convert_cmd = ''
-    if os.name == 'nt':
-        convert_cmd = r'C:\cygwin\bin\convert'
+    if is_rendered_inprocess(backend, outputs):
+        # Render using a PDF library without starting any processes.
+        (f, w, output_path) = outputs[0]
+        with span('render: ' + file_name, 'raster', file=file,
+                  renderer=get_renderer()):
+            render_image(file, output_path, f, w, quality=quality)
+        return 0
+
+    with span('touch: ' + file_name, 'raster', file=file) as s:
+        p_touch = _popen(['touch'] + [p for (f, w, p) in outputs])
+        p_touch.wait()
+        s['exit_status'] = p_touch.returncode
+
+    if backend == 'convert' and len(outputs) == 1:
+        # Let imagemagick render the page at a fixed density and resize the
+        # result to the output width.
+        (f, w, output_path) = outputs[0]
+        return convert_image(file_name + '.pdf', input_dir, output_path, w,
+                             get_density(dev), log, memory_limit, quality)
+
+    render_path = render_full(file, backend,
+                              max(w for (f, w, p) in outputs), dev,
+                              supersample, log, memory_limit)
+    if not render_path:
+        return -1
+
+    # Derive the images from the rendering in parallel, keeping any external
+    # processes in the process group of the calling thread and recording
+    # their memory use for it.
+    group = getattr(_context, 'group', None)
+    peaks = getattr(_context, 'peaks', None)
+    derived_limit = memory_limit // len(outputs) if memory_limit else None
+
+    def derive(output):
+        _context.peaks = peaks
+        if slots:
+            slots.acquire()
+        try:
+            return run_in_process_group(
+                group, convert_image, os.path.basename(render_path),
+                input_dir, output[2], output[1], None, log, derived_limit,
+                quality)
+        finally:
+            if slots:
+                slots.release()
+            _context.peaks = None
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(outputs)) as executor:
+            returncodes = list(executor.map(derive, outputs))
+    finally:
+        os.remove(render_path)
+
+    return next((r for r in returncodes if r != 0), 0)
+
+
+def get_raster_pixels(file, outputs, backend, dev, supersample):
+    # Return the number of pixels of the rendering of the page, i.e. the
+    # largest image held by any process while rasterizing, or None if the
+    # page size cannot be read or nothing is rasterized.
+    outputs = get_raster_only(outputs)
+    if not outputs:
+        return None
+    size = get_page_size(file) if os.path.exists(file) else None
+    if not size or size[0] <= 0:
+        return None
+
+    (width, height) = size
+    if get_raster_backend(backend) == 'convert':
+        scale = float(get_density(dev)) / 72.0
     else:
-        convert_cmd = 'convert'
+        scale = max(w for (f, w, p) in outputs) * \
+            get_supersample(dev, supersample) / width
+    return int(width * scale * height * scale)
 
-    p_convert = Popen(
-        [
-            convert_cmd,
-            # Remove alpha layer and replace with a solid background color.
-            '-background', 'white',
-            '-alpha', 'remove', '-alpha', 'off',
-            # Draw a thin border around the image.
-            '-bordercolor', 'gray',
-            '-border', '1',
-            # Supersampling instead to preserve color space?
-            '-density', density,
-            '-resize', '1000x',
-            '-flatten',
-            file_name + '.pdf',
-            os.path.abspath(
-                os.path.join(output_dir, file_name + '.' + output_format)
-            )
-        ],
-        cwd=os.path.abspath(input_dir),
-        stdout=ostream,
-        stderr=ostream
-    )
-    p_convert.wait()
 
-    return p_convert.returncode
+def estimate_raster_memory(pixels, outputs, backend, history=None):
+    # Estimate the peak memory use of rasterizing a page rendered with the
+    # given number of pixels. If several images are requested, they're
+    # derived from the rendering by processes running in parallel. The peak
+    # measured for a single process in an earlier run, if any, is scaled to
+    # the number of pixels and takes precedence over the model.
+    processes = len(outputs)
+    if history and history.get('pixels'):
+        peak = history['peak'] * MEASURED_MARGIN * pixels / history['pixels']
+        return int(peak * processes)
 
+    if is_rendered_inprocess(backend, outputs):
+        return estimate_memory(pixels, 'inprocess')
+    return processes * estimate_memory(pixels, 'convert')
 
-def generate_figures(source_root_dir, output_root_dir, output_format, dev,
-                     verbose):
-    print('Begin generating figures.')
-    if not os.path.exists(output_root_dir):
-        print('Creating directory ' + output_root_dir + '.')
-        os.makedirs(output_root_dir)
 
-    for (root_dir, dir_names, file_names) in os.walk(source_root_dir):
-        if CFG_FILE_NAME in file_names:
-            try:
-                with open(os.path.join(root_dir, CFG_FILE_NAME)) as cfg_file:
-                    try:
-                        cfg = json.load(cfg_file)
-                    except ValueError:
-                        # Changed from value error in Python 3.5
-                        print('WARNING: Could not parse configuration file, '
-                              'skipping directory.')
-                        continue
-            except OSError:
-                print('WARNING: Failed to open configuration file for '
-                      'reading, skipping directory.')
-                continue
-        else:
-            # Continue walking until a directory with a configuration file is
-            # encountered.
-            continue
+# The tools optimizing the images of each format after rasterization, both
+# lossless. PNG images are recompressed, reducing the bit depth and the
+# palette where possible, and JPEG images are made progressive with optimized
+# Huffman tables. Images in other formats are left as they are.
+OPTIMIZERS = {
+    'png': 'optipng',
+    'jpg': 'jpegtran'
+}
+
+
+def check_optimizers():
+    # Warn about the optimizers which are not installed. Images which cannot
+    # be optimized are published as rasterized.
+    for (f, tool) in sorted(OPTIMIZERS.items()):
+        if not shutil.which(tool):
+            echo('WARNING: \'' + tool + '\' not found, ' + f.upper() +
+                 ' images will not be optimized.')
+    return
+
 
-        # Validate configuration file contents
-        if 'targets' not in cfg:
-            print('WARNING: Configuration file did not contain the '
-                  'required field \'targets\', skipping directory.')
+def get_optimize_outputs(outputs):
+    # Return the outputs which can be optimized with the installed tools.
+    return [(f, w, p) for (f, w, p) in outputs
+            if f in OPTIMIZERS and shutil.which(OPTIMIZERS[f])]
+
+
+def get_optimize_key(outputs, toolchain):
+    # The optimized images along with the versions of the optimizers. The
+    # images are recorded by the digests of their optimized contents, so
+    # rasterizing an image again invalidates the key.
+    return {
+        'images': {os.path.basename(p): hash_file(p)
+                   for (f, w, p) in outputs},
+        'toolchain': {OPTIMIZERS[f]: toolchain[OPTIMIZERS[f]]
+                      for (f, w, p) in outputs}
+    }
+
+
+def optimize_image(path, log):
+    # Optimize the image in place and return the exit status of the
+    # optimizer. The image is left as is if the optimized image is larger,
+    # e.g. a small JPEG image made progressive.
+    tmp_path = path + '.tmp'
+    if path.endswith('.png'):
+        cmd = ['optipng', '-quiet', '-o2', '-strip', 'all', '-clobber',
+               '-out', tmp_path, path]
+    else:
+        cmd = ['jpegtran', '-copy', 'none', '-optimize', '-progressive',
+               '-outfile', tmp_path, path]
+
+    with span('optimize: ' + os.path.basename(path), 'optimize',
+              file=path) as s:
+        p = _popen(cmd, stdout=log, stderr=STDOUT)
+        _wait(p)
+        s['exit_status'] = p.returncode
+
+    if p.returncode == 0 and \
+       os.path.getsize(tmp_path) < os.path.getsize(path):
+        os.replace(tmp_path, path)
+    elif os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    return p.returncode
+
+
+def get_store_optimize_key(digest, tool, toolchain):
+    # Images are optimized by content, so identical images rasterized by
+    # different targets share the optimized image.
+    return get_key({'stage': 'optimize', 'image': digest,
+                    'toolchain': {tool: toolchain[tool]}})
+
+
+# Message written to the log by a batch document at the start of each figure,
+# holding the figure index and the number of pages shipped out so far.
+BATCH_PAGE_PATTERN = re.compile(r'cadmus-batch-page: (\d+) (\d+)')
+
+
+def split_document(file):
+    # Split a generated document into its preamble and its body. Returns None
+    # if the document does not have the expected structure.
+    with open(file) as f:
+        lines = f.readlines()
+
+    begin = next((i for (i, line) in enumerate(lines)
+                  if line.lstrip().startswith('\\begin{document}')), None)
+    end = next((i for i in reversed(range(len(lines)))
+                if lines[i].lstrip().startswith('\\end{document}')), None)
+    if begin is None or end is None or end < begin:
+        return None
+
+    return (''.join(lines[:begin]), ''.join(lines[begin + 1:end]))
+
+
+def write_batch_document(file, preamble, bodies):
+    # Write a document with the shared preamble and one figure per page. Each
+    # figure is placed in a group to keep its definitions local and the page
+    # on which the figure starts is written to the log.
+    content = preamble + '\\begin{document}\n'
+    for (i, body) in enumerate(bodies):
+        content += (
+            '\\directlua{texio.write_nl("cadmus-batch-page: ' + str(i) +
+            ' " .. status.total_pages)}\n'
+            '\\begingroup\n' + body.rstrip('\n') + '\n\\endgroup\n'
+            '\\clearpage\n'
+        )
+    content += '\\end{document}\n'
+    write_if_changed(file, content)
+    return
+
+
+def get_batches(targets, build_root_dir, batch_size, jobs):
+    # Group the targets by their preamble, i.e. targets with the same
+    # template, font, document class and packages. Groups are split into
+    # batches of at most batch_size targets, and into at least one batch per
+    # job if possible to keep the workers busy. Targets which end up alone are
+    # left out and compiled individually. The directories of batches which
+    # are no longer used are removed.
+    groups = {}
+    for t in targets:
+        parts = split_document(t['file'])
+        if parts is None:
             continue
+        (preamble, body) = parts
+        groups.setdefault(preamble, []).append((t, body))
 
-        # Replicate hierarchical structure in the output directory
-        local_output_dir = root_dir.split(source_root_dir)[1]
-        if os.name == 'nt':
-            local_output_dir = local_output_dir.strip('\\')
+    batches = []
+    for (preamble, members) in groups.items():
+        size = max(2, min(batch_size, math.ceil(len(members) / jobs)))
+        for k in range(0, len(members), size):
+            chunk = members[k:k + size]
+            if len(chunk) < 2:
+                continue
+
+            # Name the batch after its contents to reuse the auxiliary files
+            # from earlier builds of the same batch.
+            h = hashlib.sha256(preamble.encode())
+            for (t, body) in chunk:
+                h.update(t['id'].encode())
+            name = 'batch_' + h.hexdigest()[:16]
+            batch_dir = os.path.join(build_root_dir, BATCH_DIR_NAME, name)
+            if not os.path.exists(batch_dir):
+                os.makedirs(batch_dir)
+
+            file = os.path.join(batch_dir, name + '.tex')
+            write_batch_document(file, preamble, [b for (t, b) in chunk])
+            batches.append({
+                'name': name,
+                'file': file,
+                'log': os.path.join(batch_dir, LOG_FILE_NAME),
+                'targets': [t for (t, b) in chunk],
+                'preamble_format': chunk[0][0].get('preamble_format')
+            })
+
+    # Remove the batches of earlier runs which are not used by this run,
+    # e.g. after the targets have been grouped differently.
+    batch_root_dir = os.path.join(build_root_dir, BATCH_DIR_NAME)
+    if os.path.isdir(batch_root_dir):
+        names = set(b['name'] for b in batches)
+        for name in os.listdir(batch_root_dir):
+            if name not in names:
+                shutil.rmtree(os.path.join(batch_root_dir, name),
+                              ignore_errors=True)
+
+    return batches
+
+
+def build_batch(batch, adaptive):
+    # Compile a batch document and extract the target page of each figure into
+    # the figure's build directory. Returns the targets which were extracted
+    # successfully.
+    batch_dir = os.path.dirname(batch['file'])
+    batch_pdf = os.path.join(batch_dir, batch['name'] + '.pdf')
+    batch_log = os.path.join(batch_dir, batch['name'] + '.log')
+    targets = batch['targets']
+    passes = max(t['match']['passes'] for t in targets)
+
+    echo('Compiling batch \'' + batch['name'] + '\' ({} targets).'
+         .format(len(targets)))
+    with open(batch['log'], 'w') as log, \
+            span('batch: ' + batch['name'], 'target',
+                 targets=[t['id'] for t in targets]):
+        if adaptive:
+            returncode = run_lualatex_adaptive(batch['file'], batch_dir,
+                                               passes, log,
+                                               batch['preamble_format'])
         else:
-            local_output_dir = local_output_dir.strip('/')
-        # Strip any containment directory
-        # TODO: What happens if empty?
-        local_output_dir = os.path.dirname(local_output_dir)
-        # Join the reduced source path to the output directory
-        local_output_dir = os.path.join(output_root_dir, local_output_dir)
-        # Create if directory if it doesn't exist
-        if not os.path.exists(local_output_dir):
-            print('Creating output directory ' + local_output_dir + '.')
-            os.makedirs(local_output_dir)
+            returncode = run_lualatex(batch['file'], batch_dir, passes, log,
+                                      batch['preamble_format'])
+        if returncode != 0:
+            return []
 
-        for full_file_name in file_names:
-            # Search the targets for a matching entry using the full file name.
-            match = next(
-                (t for t in cfg['targets']
-                    if (
-                        'file_name' in t.keys() and
-                        t['file_name'] == full_file_name
-                )
-                ),
-                None
-            )
+        try:
+            with open(batch_log, errors='replace') as f:
+                starts = {int(m.group(1)): int(m.group(2)) for m in
+                          BATCH_PAGE_PATTERN.finditer(f.read())}
+        except OSError:
+            return []
 
-            # Skip if the file name if no matching target entry is found
-            if not match:
+        extracted = []
+        for (i, t) in enumerate(targets):
+            if i not in starts:
                 continue
 
-            # Check target entry for keys which have default values
-            if 'page' not in match:
-                match['page'] = 1
-            if 'format' not in match:
-                match['format'] = 'jpg'
-            if 'passes' not in match:
-                match['passes'] = 1
-            if 'crop' not in match:
-                match['crop'] = True
-            if 'crop_margins' not in match:
-                match['crop_margins'] = '10'
-
-            # Validate settings
-            if match['page'] < 1:
-                print('WARNING: Invalid target page {}, '
-                      'valid range: > 0. Skipping this entry.'
-                      .format(match['page']))
-                continue
-            if match['passes'] < 1:
-                print('WARNING: Invalid number of passes {} '
-                      'valid range: > 0. Skipping this entry.'
-                      .format(match['passes']))
+            # The target page has to be within the pages of the figure.
+            page = starts[i] + t['match']['page']
+            if (i + 1) in starts and page > starts[i + 1]:
+                _log(log, 'WARNING: \'' + t['id'] + '\' did not produce '
+                          'the target page in the batch.')
                 continue
 
-            (file_name, file_type) = full_file_name.split('.')
+            pdf_file = os.path.splitext(t['file'])[0] + '.pdf'
+            if extract_page(batch_pdf, pdf_file, page, t['match']['crop'],
+                            t['match']['crop_margins'], log) == 0:
+                extracted.append(t)
 
-            # Skip unsupported file types (TODO: Needed?)
-            if (file_type != 'tex'):
-                continue
+    return extracted
 
-            # Generate PDF using the same directory as the source file for the
-            # output.
-            print(
+
+def get_compile_reasons(target, cache, compile_key):
+    # Return the reasons why the target has to be compiled. An empty list
+    # indicates that the PDF is up to date.
+    if not cache:
+        return ['build cache disabled']
+
+    reasons = cache.check(target['id'], 'compile', compile_key)
+    if not reasons and \
+       not os.path.exists(os.path.splitext(target['file'])[0] + '.pdf'):
+        reasons = ['PDF missing']
+    return reasons
+
+
+def get_source_root(target):
+    # Return the source root directory of the target.
+    source_dir = os.path.dirname(target['source'])
+    return os.path.normpath(os.path.join(
+        source_dir, os.path.relpath(os.curdir, target['local_dir'])))
+
+
+def to_store_path(path, root_dir):
+    # Files in the source tree are identified relative to its root in the
+    # shared store, since each build tree may have its own copy.
+    rel_path = os.path.relpath(path, root_dir)
+    if rel_path == os.pardir or rel_path.startswith(os.pardir + os.sep):
+        return path
+    return rel_path
+
+
+def get_store_compile_key(compile_key):
+    # The compile key without the locations of the files, which may differ
+    # between build trees. The files recorded as inputs are matched against
+    # each variant in the store instead.
+    return get_key({
+        'stage': 'compile',
+        'source': compile_key['source'],
+        'template': sorted(compile_key['template'].values(),
+                           key=lambda d: d or ''),
+        'settings': compile_key['settings'],
+        'toolchain': compile_key['toolchain']
+    })
+
+
+def fetch_pdf(target, pdf_file, store, compile_key):
+    # Copy the compiled document from the shared store if a variant whose
+    # inputs match the files in this tree is stored, updating the inputs of
+    # the compile key. Returns True if the document was fetched.
+    root_dir = get_source_root(target)
+    for variant in store.get_variants(get_store_compile_key(compile_key)):
+        inputs = {os.path.join(root_dir, p): d
+                  for (p, d) in variant['inputs'].items()}
+        if all(hash_file(p) == d for (p, d) in inputs.items()) and \
+           store.fetch(variant['object'], {'document.pdf': pdf_file}):
+            compile_key['inputs'] = inputs
+            return True
+    return False
+
+
+def store_pdf(target, pdf_file, store, compile_key):
+    root_dir = get_source_root(target)
+    key = get_store_compile_key(compile_key)
+    inputs = {to_store_path(p, root_dir): d
+              for (p, d) in compile_key['inputs'].items()}
+    object_key = get_key({'compile': key, 'inputs': inputs})
+    if store.put(object_key, {'document.pdf': pdf_file}):
+        store.add_variant(key, {'inputs': inputs, 'object': object_key})
+    return
+
+
+def get_default_scratch_dir():
+    # Prefer a file system in RAM for the scratch directories.
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def get_store(cache_dir, cache_size):
+    # Open the shared store in the directory, if given. The build continues
+    # without the store if it cannot be created.
+    if not cache_dir:
+        return None
+    try:
+        return ArtifactStore(cache_dir, parse_size(cache_size or
+                                                   DEFAULT_STORE_SIZE))
+    except OSError as e:
+        echo('WARNING: Failed to open the cache directory \'' + cache_dir +
+             '\' (' + str(e) + '), building without it.')
+        return None
+
+
+def get_store_raster_key(raster_key):
+    return get_key({'stage': 'raster', 'raster': raster_key})
+
+
+def get_store_images(outputs):
+    # Name the images in the shared store by their width and format.
+    return {('image-{}.{}'.format(w, f) if w else 'image.' + f): p
+            for (f, w, p) in outputs}
+
+
+def estimate_target_memory(target, state, dev, cache, backend, supersample):
+    # Estimate the peak memory use of rasterizing the target once compiled,
+    # or return None if the page size is unknown. Vector formats are not
+    # accounted for.
+    outputs = get_raster_only(state['outputs'])
+    if not outputs:
+        return 0
+    pixels = get_raster_pixels(state['pdf_file'], outputs, backend, dev,
+                               supersample)
+    if not pixels:
+        return None
+    return estimate_raster_memory(
+        pixels, outputs, backend,
+        cache.get(target['id'], 'memory') if cache else None)
+
+
+def rasterize_target(target, file, output_dir, outputs, dev, log, backend,
+                     supersample, cache=None, reserved=None, s=None,
+                     slots=None):
+    # Rasterize the target, limiting imagemagick to the memory reserved for
+    # it if given, and the images derived at a time to the slots of the
+    # semaphore, see rasterize(). The peak memory use of the processes is
+    # recorded in the build cache to refine the estimate for the next run,
+    # unless imagemagick was limited to less memory than estimated.
+    match = target['match']
+    raster_outputs = get_raster_only(outputs)
+    pixels = get_raster_pixels(file, outputs, backend, dev, supersample)
+    svg_fonts = match.get('svg_fonts', 'paths')
+    limited = False
+    if reserved is not None and raster_outputs:
+        estimate = estimate_raster_memory(
+            pixels, raster_outputs, backend,
+            cache.get(target['id'], 'memory') if cache else None
+        ) if pixels else None
+        limited = estimate is None or reserved < estimate
+        if s is not None:
+            s['memory'] = reserved
+    _context.peaks = []
+    try:
+        returncode = rasterize(file, output_dir, match['format'], dev, log,
+                               match['width'], backend, supersample,
+                               reserved or None, match.get('quality'),
+                               svg_fonts, slots)
+        peaks = _context.peaks
+    finally:
+        _context.peaks = None
+
+    if returncode == 0 and cache and pixels and peaks and not limited:
+        cache.update(target['id'], 'memory',
+                     {'peak': max(peaks), 'pixels': pixels})
+    return returncode
+
+
+def start_target(target, scratch_dir=None):
+    # Return the state shared by the stages of the target. If a scratch
+    # directory is given, the target is compiled and rasterized in a
+    # directory of its own below it, see get_work_dir(). The auxiliary file
+    # is carried over between the build tree and the scratch directory, see
+    # compile_target().
+    full_file_name = os.path.basename(target['file'])
+    (file_name, file_type) = full_file_name.split('.')
+    match = target['match']
+    pdf_file = os.path.join(os.path.dirname(target['file']),
+                            file_name + '.pdf')
+    aux_file = os.path.join(os.path.dirname(target['file']),
+                            file_name + '.aux')
+
+    return {
+        'full_file_name': full_file_name,
+        'file_name': file_name,
+        'pdf_file': pdf_file,
+        'scratch_dir': scratch_dir,
+        'work_dir': None,
+        'work_pdf_file': pdf_file,
+        'aux_file': aux_file,
+        'work_aux_file': aux_file,
+        'outputs': get_raster_outputs(file_name, target['output_dir'],
+                                      match['format'], match['width'])
+    }
+
+
+def get_work_dir(state):
+    # Return the scratch directory of the target, creating it when the first
+    # stage actually runs so that targets which are up to date don't touch
+    # the scratch directory at all. Returns None if the target is built in
+    # the build tree.
+    if state['scratch_dir'] and not state['work_dir']:
+        file_name = state['file_name']
+        try:
+            work_dir = tempfile.mkdtemp(prefix='cadmus-' + file_name + '-',
+                                        dir=state['scratch_dir'])
+        except OSError as e:
+            echo('WARNING: Failed to create a scratch directory for \'' +
+                 state['full_file_name'] + '\' (' + str(e) + '), building '
+                 'in the build tree.')
+            state['scratch_dir'] = None
+            return None
+        state['work_dir'] = work_dir
+        state['work_pdf_file'] = os.path.join(work_dir, file_name + '.pdf')
+        state['work_aux_file'] = os.path.join(work_dir, file_name + '.aux')
+    return state['work_dir']
+
+
+def compile_target(target, state, cache=None, toolchain=None, explain=False,
+                   adaptive=False, progress=None, store=None):
+    # The compile stage of build_target(). Returns True if the PDF is up to
+    # date.
+    if not progress:
+        progress = lambda *args: None
+
+    full_file_name = state['full_file_name']
+    file_name = state['file_name']
+    pdf_file = state['pdf_file']
+    match = target['match']
+    success = True
+
+    with open(target['log'], 'w') as log:
+        compile_key = get_compile_key(target, toolchain, cache) \
+            if cache else None
+        if target.get('batch'):
+            reasons = []
+            _log(log, 'Compiled in batch \'' + target['batch'] + '\'.')
+            echo('PDF extracted from batch: \'' + file_name + '.pdf\'.')
+            if cache:
+                record_inputs(target, compile_key, toolchain)
+                cache.update(target['id'], 'compile', compile_key)
+                if store:
+                    store_pdf(target, pdf_file, store, compile_key)
+            progress(target, 'compile', 'done')
+        else:
+            reasons = get_compile_reasons(target, cache, compile_key)
+            if not reasons:
+                echo('PDF is up to date: \'' + file_name + '.pdf\'.')
+                progress(target, 'compile', 'skipped')
+            elif store and fetch_pdf(target, pdf_file, store, compile_key):
+                reasons = []
+                echo('PDF fetched from the cache: \'' + file_name +
+                     '.pdf\'.')
+                cache.update(target['id'], 'compile', compile_key)
+                progress(target, 'compile', 'skipped')
+
+        if reasons:
+            if explain:
+                echo('Compiling \'' + full_file_name + '\': ' +
+                     ', '.join(reasons) + '.')
+            echo(
                 'Generating PDF: \'' +
                 full_file_name + '\' -> \'' +
                 file_name + '.pdf\'.'
             )
-            try:
-                generate_pdf(
-                    os.path.join(root_dir, full_file_name),
-                    None,
-                    match['page'],
-                    match['passes'],
-                    match['crop'],
-                    match['crop_margins'],
-                    verbose
-                )
-            except ValueError as e:
-                print('ERROR: ' + str(e))
-                pass
-            print(
-                'Converting to ' + match['format'].upper() + ': \'' +
-                file_name + '.pdf\' -> \'' +
-                file_name + '.' + match['format'] + '\'.'
+            if cache:
+                cache.invalidate(target['id'], 'compile')
+            progress(target, 'compile', 'started')
+            work_dir = get_work_dir(state)
+            # Generate PDF using the same directory as the source file for the
+            # output. The auxiliary file of the last build is copied to the
+            # scratch directory, if any, so that an unchanged document still
+            # converges in the first pass, and copied back on success.
+            with span('compile: ' + target['id'], 'target') as s:
+                try:
+                    if work_dir and os.path.exists(state['aux_file']):
+                        copy_file(state['aux_file'], state['work_aux_file'])
+                    if generate_pdf(
+                        target['file'],
+                        work_dir,
+                        match['page'],
+                        match['passes'],
+                        match['crop'],
+                        match['crop_margins'],
+                        log,
+                        adaptive,
+                        target.get('preamble_format')
+                    ) != 0:
+                        success = False
+                    else:
+                        if work_dir:
+                            copy_file(state['work_pdf_file'], pdf_file)
+                            if os.path.exists(state['work_aux_file']):
+                                copy_file(state['work_aux_file'],
+                                          state['aux_file'])
+                        if cache:
+                            record_inputs(target, compile_key, toolchain,
+                                          work_dir)
+                            cache.update(target['id'], 'compile',
+                                         compile_key)
+                        if store:
+                            store_pdf(target, pdf_file, store, compile_key)
+                except (ValueError, OSError) as e:
+                    echo('ERROR: ' + str(e))
+                    success = False
+                s['success'] = success
+            progress(target, 'compile', 'done' if success else 'failed')
+
+    return success
+
+
+def raster_target(target, state, dev, cache=None, toolchain=None,
+                  explain=False, progress=None, raster_backend='convert',
+                  supersample=2, store=None, reserved=None, slots=None):
+    # The raster stage of build_target(). Returns True if the images are up
+    # to date. Imagemagick is limited to the memory reserved for the target,
+    # if given, see rasterize_target() for the slots.
+    if not progress:
+        progress = lambda *args: None
+
+    file_name = state['file_name']
+    pdf_file = state['pdf_file']
+    outputs = state['outputs']
+    match = target['match']
+    rastered = True
+
+    with open(target['log'], 'a') as log:
+        raster_key = None
+        if cache:
+            raster_key = get_raster_key(pdf_file, match['format'], dev,
+                                        toolchain, match['width'],
+                                        raster_backend, supersample,
+                                        match.get('quality'),
+                                        match.get('svg_fonts', 'paths'))
+            reasons = cache.check(target['id'], 'raster', raster_key)
+            if not reasons and \
+               not all(os.path.exists(p) for (f, w, p) in outputs):
+                reasons = ['image missing']
+        else:
+            reasons = ['build cache disabled']
+
+        if not reasons:
+            echo('Image is up to date: ' +
+                 ', '.join('\'' + os.path.basename(p) + '\''
+                           for (f, w, p) in outputs) + '.')
+            progress(target, 'raster', 'skipped')
+        elif store and store.fetch(get_store_raster_key(raster_key),
+                                   get_store_images(outputs)):
+            echo('Image fetched from the cache: ' +
+                 ', '.join('\'' + os.path.basename(p) + '\''
+                           for (f, w, p) in outputs) + '.')
+            cache.update(target['id'], 'raster', raster_key)
+            progress(target, 'raster', 'skipped')
+        else:
+            if explain:
+                echo('Rasterizing \'' + file_name + '.pdf\': ' +
+                     ', '.join(reasons) + '.')
+            echo(
+                'Converting to ' +
+                '/'.join(sorted(set(f.upper() for (f, w, p) in outputs))) +
+                ': \'' + file_name + '.pdf\' -> ' +
+                ', '.join('\'' + os.path.basename(p) + '\''
+                          for (f, w, p) in outputs) + '.'
             )
+            if cache:
+                cache.invalidate(target['id'], 'raster')
+            progress(target, 'raster', 'started')
+            work_dir = get_work_dir(state)
+            work_pdf_file = state['work_pdf_file']
             # Convert to image and move to the target output direcory.
+            with span('raster: ' + target['id'], 'target') as s:
+                try:
+                    if work_dir and not os.path.exists(work_pdf_file) and \
+                       os.path.exists(pdf_file):
+                        copy_file(pdf_file, work_pdf_file)
+                    if rasterize_target(
+                        target,
+                        work_pdf_file,
+                        work_dir or target['output_dir'],
+                        outputs,
+                        dev,
+                        log,
+                        raster_backend,
+                        supersample,
+                        cache,
+                        reserved,
+                        s,
+                        slots
+                    ) != 0:
+                        rastered = False
+                    else:
+                        if work_dir:
+                            for (f, w, p) in outputs:
+                                copy_file(os.path.join(work_dir,
+                                                       os.path.basename(p)),
+                                          p)
+                        if cache:
+                            cache.update(target['id'], 'raster', raster_key)
+                        if store:
+                            store.put(get_store_raster_key(raster_key),
+                                      get_store_images(outputs))
+                except (ValueError, OSError) as e:
+                    echo('ERROR: ' + str(e))
+                    rastered = False
+                s['success'] = rastered
+            progress(target, 'raster', 'done' if rastered else 'failed')
+
+    return rastered
+
+
+def skip_raster(target, state, progress=None):
+    # Called instead of raster_target() if the target failed to compile,
+    # leaving any images from an earlier build in place.
+    echo('Skipping rasterization of \'' + state['file_name'] + '.pdf\' '
+         'since \'' + state['full_file_name'] + '\' failed to compile.')
+    if progress:
+        progress(target, 'raster', 'skipped')
+    return
+
+
+def optimize_target(target, state, cache=None, toolchain=None,
+                    explain=False, progress=None, store=None):
+    # The optimize stage of build_target(), run on the images in the output
+    # directory. Returns True if the images are optimized.
+    if not progress:
+        progress = lambda *args: None
+
+    outputs = get_optimize_outputs(state['outputs'])
+    if not outputs:
+        progress(target, 'optimize', 'skipped')
+        return True
+
+    optimized = True
+    names = ', '.join('\'' + os.path.basename(p) + '\''
+                      for (f, w, p) in outputs)
+    with open(target['log'], 'a') as log:
+        recorded = {}
+        if cache:
+            key = get_optimize_key(outputs, toolchain)
+            reasons = cache.check(target['id'], 'optimize', key)
+            entry = cache.get(target['id'], 'optimize')
+            if entry and entry.get('toolchain') == key['toolchain']:
+                recorded = entry['images']
+        else:
+            reasons = ['build cache disabled']
+
+        if not reasons:
+            echo('Image is optimized: ' + names + '.')
+            progress(target, 'optimize', 'skipped')
+            return True
+
+        if explain:
+            echo('Optimizing ' + names + ': ' + ', '.join(reasons) + '.')
+        echo('Optimizing: ' + names + '.')
+        if cache:
+            cache.invalidate(target['id'], 'optimize')
+        progress(target, 'optimize', 'started')
+        with span('optimize: ' + target['id'], 'target') as s:
             try:
-                rasterize(
-                    os.path.join(root_dir, file_name + '.pdf'),
-                    local_output_dir,
-                    match['format'],
-                    dev,
-                    verbose
-                )
-            except ValueError as e:
-                print('ERROR: ' + str(e))
-                pass
-            print('')
-
-    print('Done generating figures.\n')
+                for (f, w, p) in outputs:
+                    # Skip the images optimized by the last build which have
+                    # not been rasterized since.
+                    digest = hash_file(p)
+                    if recorded.get(os.path.basename(p)) == digest:
+                        continue
+
+                    store_key = get_store_optimize_key(
+                        digest, OPTIMIZERS[f], toolchain) if store else None
+                    if store and store.fetch(store_key, {'image': p}):
+                        continue
+                    if optimize_image(p, log) != 0:
+                        optimized = False
+                        break
+                    if store:
+                        store.put(store_key, {'image': p})
+
+                if optimized and cache:
+                    cache.update(target['id'], 'optimize',
+                                 get_optimize_key(outputs, toolchain))
+            except (ValueError, OSError) as e:
+                echo('ERROR: ' + str(e))
+                optimized = False
+            s['success'] = optimized
+        progress(target, 'optimize', 'done' if optimized else 'failed')
+
+    return optimized
+
+
+def finish_target(target, state, success, verbose):
+    # Remove the scratch directory of the target if it was built
+    # successfully and echo the log if requested.
+    work_dir = state['work_dir']
+    if work_dir:
+        if success:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        else:
+            echo('Keeping the scratch directory of \'' +
+                 state['full_file_name'] + '\': \'' + work_dir + '\'.')
+
+    if verbose:
+        with open(target['log']) as log:
+            echo('Console output from building \'' +
+                 state['full_file_name'] + '\':\n' + log.read())
     return
+
+
+def build_target(target, dev, verbose, cache=None, toolchain=None,
+                 explain=False, adaptive=False, progress=None,
+                 raster_backend='convert', supersample=2, store=None,
+                 scratch_dir=None, memory=None, optimize=False):
+    # Build a single target, directing all console output from the external
+    # tools to a log file in the target's build directory. The log is echoed
+    # in one piece when the target is done if verbose output is requested,
+    # that way the output from concurrent builds does not interleave. The
+    # target is not rasterized if it fails to compile.
+    #
+    # If a build cache is given, each stage is skipped if its key matches the
+    # key recorded by the last successful build. Targets compiled as part of
+    # a batch only have to be rasterized. If a shared store is given as well,
+    # the results of the stages are fetched from the store when possible and
+    # added to the store otherwise.
+    #
+    # If a scratch directory is given, the target is compiled and rasterized
+    # in a directory of its own below it, e.g. on a file system in RAM, and
+    # only the final PDF and images are copied to the build tree and the
+    # output directory. The directory is removed if the build succeeds and
+    # kept for debugging otherwise.
+    #
+    # If a memory budget is given, rasterization waits until its estimated
+    # peak memory use fits within the budget and imagemagick is limited to
+    # the memory reserved. Compilation is not limited. Builds of several
+    # targets wait for the budget without occupying a job, see
+    # build_targets().
+    #
+    # If requested, the images are optimized once rasterized, see
+    # OPTIMIZERS. The optimized images are recorded in the build cache and
+    # in the shared store by the digest of the rasterized image, so an image
+    # is only optimized again once it has been rasterized again.
+    #
+    # The progress callback, if given, is called as progress(target, stage,
+    # status) when a stage starts ('started') and when it ends ('done',
+    # 'failed' or 'skipped' if it was up to date or an earlier stage
+    # failed).
+    state = start_target(target, scratch_dir)
+    success = compile_target(target, state, cache, toolchain, explain,
+                             adaptive, progress, store)
+    if success:
+        reserved = memory.acquire(estimate_target_memory(
+            target, state, dev, cache, raster_backend, supersample)) \
+            if memory else None
+        try:
+            success = raster_target(target, state, dev, cache, toolchain,
+                                    explain, progress, raster_backend,
+                                    supersample, store, reserved)
+        finally:
+            if memory:
+                memory.release(reserved)
+    else:
+        skip_raster(target, state, progress)
+    if success and optimize:
+        success = optimize_target(target, state, cache, toolchain, explain,
+                                  progress, store)
+    finish_target(target, state, success, verbose)
+    return success
+
+
+def collect_targets(source_root_dir, output_root_dir, exclude_dirs=None,
+                    include_dirs=None):
+    # Collect the targets to build from the manifest written to the build
+    # tree when the sources were generated. Targets in excluded directories
+    # are left out, as are targets outside the directories to include if
+    # given.
+    manifest = read_manifest(source_root_dir)
+    if manifest is None:
+        echo('WARNING: No manifest found in \'' + source_root_dir + '\', '
+             'generate the sources first.')
+        return []
+
+    targets = []
+    for entry in manifest:
+        target_dir = os.path.join(source_root_dir,
+                                  os.path.dirname(entry['id']))
+        if exclude_dirs and target_dir in exclude_dirs:
+            continue
+        if include_dirs is not None and target_dir not in include_dirs:
+            continue
+
+        # Replicate the source tree in the output directory
+        local_output_dir = os.path.normpath(
+            os.path.join(output_root_dir, entry['local_dir']))
+        if not os.path.exists(local_output_dir):
+            echo('Creating output directory ' + local_output_dir + '.')
+            os.makedirs(local_output_dir)
+
+        targets.append({
+            'id': entry['id'],
+            'file': os.path.join(source_root_dir, entry['id']),
+            'source': entry['source'],
+            'local_dir': entry['local_dir'],
+            'log': os.path.join(target_dir, LOG_FILE_NAME),
+            'output_dir': local_output_dir,
+            'match': entry['match']
+        })
+
+    return targets
+
+
+def prepare_formats(targets, jobs):
+    # Dump the precompiled formats used by the targets. Targets whose format
+    # is not available are compiled without it.
+    preamble_formats = sorted(set(t['match']['preamble_format']
+                                  for t in targets
+                                  if t['match'].get('preamble_format')))
+    if preamble_formats:
+        echo('Dumping {} format(s).'.format(len(preamble_formats)))
+        available = generate_formats(preamble_formats, jobs)
+        for t in targets:
+            if t['match'].get('preamble_format') in available:
+                t['preamble_format'] = t['match']['preamble_format']
+    return
+
+
+def prepare_batches(targets, build_root_dir, cache, toolchain, explain,
+                    batch_size, jobs, store=None):
+    # Return the batches in which the targets which are out of date can be
+    # compiled. Targets whose document can be fetched from the shared store
+    # are left out.
+    pending = []
+    for t in targets:
+        key = get_compile_key(t, toolchain, cache) if cache else None
+        reasons = get_compile_reasons(t, cache, key)
+        if reasons and store and fetch_pdf(
+            t, os.path.splitext(t['file'])[0] + '.pdf', store, key
+        ):
+            cache.update(t['id'], 'compile', key)
+        elif reasons:
+            if explain:
+                echo('Compiling \'' + t['id'] + '\': ' +
+                     ', '.join(reasons) + '.')
+            pending.append(t)
+
+    batches = get_batches(pending, build_root_dir, batch_size, jobs)
+    echo('Compiling {} target(s) in {} batch(es).'.format(
+        sum(len(b['targets']) for b in batches), len(batches)))
+    return batches
+
+
+def finish_batch(batch, extracted):
+    # Mark the targets extracted from the batch. The remaining targets are
+    # compiled individually.
+    for t in extracted:
+        t['batch'] = batch['name']
+        t['recorder'] = os.path.splitext(batch['file'])[0] + '.fls'
+    for t in batch['targets']:
+        if 'batch' not in t:
+            echo('WARNING: Failed to compile \'' + t['id'] + '\' in batch '
+                 '\'' + batch['name'] + '\' (see \'' + batch['log'] +
+                 '\'), compiling individually.')
+    return
+
+
+def print_summary(targets, results):
+    succeeded = [t for (t, r) in zip(targets, results) if r]
+    failed = [t for (t, r) in zip(targets, results) if not r]
+
+    echo('')
+    echo('Summary: {} succeeded, {} failed.'
+         .format(len(succeeded), len(failed)))
+    for t in succeeded:
+        echo('  OK:     ' + t['file'])
+    for t in failed:
+        echo('  FAILED: ' + t['file'] + ' (see \'' + t['log'] + '\')')
+    return
+
+
+def build_targets(targets, batches, jobs, dev, verbose, cache=None,
+                  toolchain=None, explain=False, adaptive=False,
+                  raster_backend='convert', supersample=2, store=None,
+                  scratch_dir=None, memory=None, optimize=False,
+                  progress=None, group=None):
+    # Build the targets, and the batches in which some of them are compiled,
+    # with at most 'jobs' stages running at a time, and return a list of
+    # results, True for each target built successfully. See build_target()
+    # for the remaining arguments.
+    #
+    # The stages of the targets are run as a graph of tasks so that a target
+    # is rasterized as soon as it has been compiled while other targets are
+    # still compiling, and not at all if it fails to compile. Later stages
+    # take precedence over compiling further targets once a job is free. The
+    # last stage of a target is optimization, if requested.
+    #
+    # If a memory budget is given, a target is not rasterized until its
+    # estimated peak memory use fits within the budget. The target waits
+    # without occupying a job, so compilation keeps running at full
+    # parallelism in the meantime.
+    #
+    # The external processes are started as members of the process group,
+    # if given, and the progress callback is also called with the stage
+    # 'target' when a target is done.
+    states = {}
+    last_stage = 'optimize' if optimize else 'raster'
+    # The images derived from the renderings of the targets are converted in
+    # parallel, at most 'jobs' at a time across the targets.
+    slots = threading.BoundedSemaphore(jobs)
+
+    def run_batch(b):
+        finish_batch(b, build_batch(b, adaptive))
+        return True
+
+    def run_compile(t):
+        states[t['id']] = start_target(t, scratch_dir)
+        return compile_target(t, states[t['id']], cache, toolchain, explain,
+                              adaptive, progress, store)
+
+    def run_raster(t, reserved=None):
+        success = raster_target(t, states[t['id']], dev, cache, toolchain,
+                                explain, progress, raster_backend,
+                                supersample, store, reserved, slots)
+        if not optimize:
+            finish(t, success)
+        return success
+
+    def run_optimize(t):
+        success = optimize_target(t, states[t['id']], cache, toolchain,
+                                  explain, progress, store)
+        finish(t, success)
+        return success
+
+    def finish(t, success):
+        finish_target(t, states[t['id']], success, verbose)
+        if progress:
+            progress(t, 'target', 'done' if success else 'failed')
+        return
+
+    def on_skip(name):
+        (stage, target_id) = name.split(': ', 1)
+        t = next(t for t in targets if t['id'] == target_id)
+        if stage == 'raster':
+            skip_raster(t, states[t['id']], progress)
+        if stage == last_stage:
+            finish(t, False)
+        return
+
+    def task(func, *args):
+        return lambda *extra: run_in_process_group(group, func,
+                                                   *(args + extra))
+
+    def estimate(t):
+        return lambda: estimate_target_memory(
+            t, states[t['id']], dev, cache, raster_backend, supersample)
+
+    graph = TaskGraph()
+    batch_tasks = {}
+    for b in batches:
+        name = graph.add('batch: ' + b['name'], task(run_batch, b))
+        for t in b['targets']:
+            batch_tasks[t['id']] = [name]
+
+    for t in targets:
+        graph.add('compile: ' + t['id'], task(run_compile, t),
+                  batch_tasks.get(t['id']))
+        graph.add('raster: ' + t['id'], task(run_raster, t),
+                  ['compile: ' + t['id']], 1,
+                  estimate(t) if memory else None)
+        if optimize:
+            graph.add('optimize: ' + t['id'], task(run_optimize, t),
+                      ['raster: ' + t['id']], 2)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        status = graph.run(executor, on_skip, jobs, memory)
+    return [status[last_stage + ': ' + t['id']] == 'done' for t in targets]
+
+
+def generate_figures(source_root_dir, output_root_dir, output_format, dev,
+                     verbose, jobs=None, use_cache=True, explain=False,
+                     exclude_dirs=None, adaptive=False, batch=False,
+                     batch_size=20, raster_backend='convert', supersample=2,
+                     include_dirs=None, cache_dir=None, cache_size=None,
+                     scratch_dir=None, max_memory=None, optimize=False):
+    # Build the targets collected from the build tree and return a dict
+    # mapping each target to True if it was built successfully.
+    echo('Begin generating figures.')
+    if not os.path.exists(output_root_dir):
+        echo('Creating directory ' + output_root_dir + '.')
+        os.makedirs(output_root_dir)
+
+    # Default to one job per CPU.
+    if not jobs:
+        jobs = os.cpu_count() or 1
+
+    check_raster_backend(raster_backend)
+    if optimize:
+        check_optimizers()
+
+    # Collect the targets from the build tree and build them afterwards since
+    # the targets are independent and may be built concurrently.
+    targets = collect_targets(source_root_dir, output_root_dir, exclude_dirs,
+                              include_dirs)
+    prepare_formats(targets, jobs)
+
+    # The build cache is stored in the build root directory and persists
+    # between runs.
+    cache = BuildCache(source_root_dir) if use_cache else None
+    toolchain = get_toolchain_versions() if use_cache else None
+
+    # The shared store, if specified, is used along with the build cache.
+    store = get_store(cache_dir, cache_size) if use_cache else None
+
+    if scratch_dir and not os.path.exists(scratch_dir):
+        echo('Creating scratch directory ' + scratch_dir + '.')
+        os.makedirs(scratch_dir)
+
+    # Rasterize within the memory budget, if specified.
+    memory = MemoryBudget(max_memory) if max_memory else None
+
+    # Build the targets using a pool of worker threads. The heavy lifting is
+    # done by external processes so threads are sufficient.
+    echo('Building {} target(s) using {} job(s).'.format(len(targets), jobs))
+    try:
+        # Compile the targets which are out of date in batches, where
+        # possible. Targets which fail to compile as part of a batch are
+        # compiled individually once the batch is done.
+        batches = prepare_batches(targets, source_root_dir, cache, toolchain,
+                                  explain, batch_size, jobs, store) \
+            if batch else []
+        results = build_targets(targets, batches, jobs, dev, verbose, cache,
+                                toolchain, explain, adaptive, raster_backend,
+                                supersample, store, scratch_dir, memory,
+                                optimize)
+    finally:
+        # Save the stages that did complete, even if interrupted.
+        if cache:
+            cache.save()
+        if store:
+            store.evict()
+
+    print_summary(targets, results)
+    echo('Done generating figures.\n')
+    return {t['id']: r for (t, r) in zip(targets, results)}
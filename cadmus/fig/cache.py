@@ -0,0 +1,125 @@
+import os
+import json
+import hashlib
+import threading
+
+from .common import CACHE_FILE_NAME, echo
+
+
+# The digests computed so far, keyed by path. Each entry holds the
+# modification time and size of the file at the time of hashing along with
+# the digest, since many targets depend on the same files.
+_digests = {}
+_digests_lock = threading.Lock()
+
+
+def hash_file(path):
+    # Return the SHA-256 digest of the file contents or None if the file cannot
+    # be read.
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _digests_lock:
+        entry = _digests.get(path)
+    if entry and entry[0] == stamp:
+        return entry[1]
+
+    h = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                h.update(chunk)
+    except OSError:
+        return None
+
+    with _digests_lock:
+        _digests[path] = (stamp, h.hexdigest())
+    return h.hexdigest()
+
+
+class BuildCache:
+    # Locals
+    path_ = None
+    entries_ = None  # A dict of stage keys per target, i.e.
+    # entries_[target][stage] = key, where the key is a dict of components.
+    lock_ = None
+
+    # Constructor
+    def __init__(self, root_dir):
+        self.path_ = os.path.join(root_dir, CACHE_FILE_NAME)
+        self.entries_ = {}
+        self.lock_ = threading.Lock()
+        self.load()
+        return
+
+    def load(self):
+        if not os.path.exists(self.path_):
+            return
+
+        try:
+            with open(self.path_) as f:
+                self.entries_ = json.load(f)
+        except (OSError, ValueError):
+            echo('WARNING: Failed to read the build cache \'' + self.path_ +
+                 '\', rebuilding all targets.')
+            self.entries_ = {}
+        return
+
+    def save(self):
+        # Write to a temporary file and move it into place to avoid leaving a
+        # truncated cache behind if interrupted.
+        tmp_path = self.path_ + '.tmp'
+        with self.lock_:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries_, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path_)
+        return
+
+    def check(self, target, stage, key):
+        # Compare the key against the cached entry and return a list of reasons
+        # why the stage has to be rebuilt. An empty list indicates a cache hit.
+        with self.lock_:
+            cached = self.entries_.get(target, {}).get(stage)
+
+        if cached is None:
+            return ['no previous build']
+
+        reasons = []
+        for (component, value) in sorted(key.items()):
+            if component not in cached:
+                reasons.append(component + ' not recorded')
+            elif isinstance(value, dict) and \
+                    isinstance(cached[component], dict) and \
+                    set(value) == set(cached[component]):
+                # Name the entries which changed, e.g. a single input file.
+                reasons += ['{} \'{}\' changed'.format(component, k)
+                            for k in sorted(value)
+                            if cached[component][k] != value[k]]
+            elif cached[component] != value:
+                reasons.append(component + ' changed')
+        return reasons
+
+    def get(self, target, stage):
+        # Return the entry recorded for the stage of the target, if any.
+        with self.lock_:
+            return self.entries_.get(target, {}).get(stage)
+
+    def get_inputs(self, target):
+        # Return the files recorded as inputs by the last successful
+        # compilation of the target.
+        with self.lock_:
+            cached = self.entries_.get(target, {}).get('compile', {})
+            return sorted(cached.get('inputs', {}))
+
+    def update(self, target, stage, key):
+        with self.lock_:
+            self.entries_.setdefault(target, {})[stage] = key
+        return
+
+    def invalidate(self, target, stage):
+        with self.lock_:
+            self.entries_.get(target, {}).pop(stage, None)
+        return
@@ -1 +1,72 @@
+import os
+import shutil
+import threading
+
 CFG_FILE_NAME = 'cadmus.cfg'
+LOG_FILE_NAME = 'cadmus.log'
+CACHE_FILE_NAME = 'cadmus_cache.json'
+MANIFEST_FILE_NAME = 'cadmus_manifest.json'
+FORMAT_DIR_NAME = 'cadmus_formats'
+BATCH_DIR_NAME = 'cadmus_batches'
+
+# Serializes console output from the worker threads.
+_print_lock = threading.Lock()
+
+# The function receiving the console output of the build running in the
+# current thread, if it isn't printed.
+_output = threading.local()
+
+
+def echo(*args):
+    # Print a line of console output, or pass it to the output function of
+    # the current thread, if set.
+    output = getattr(_output, 'func', None)
+    if output:
+        output(' '.join(str(a) for a in args))
+        return
+    with _print_lock:
+        print(*args)
+    return
+
+
+def set_output(func):
+    # Pass the console output of the current thread to the function, or
+    # print it if None. Returns the previous output function.
+    previous = getattr(_output, 'func', None)
+    _output.func = func
+    return previous
+
+
+def write_if_changed(path, content):
+    # Write the content to the file unless the file already holds exactly the
+    # same bytes. Leaving an unchanged file untouched preserves its
+    # modification time. The content is written to a temporary file and moved
+    # into place to avoid leaving a truncated file behind if interrupted.
+    # Returns True if the file was written.
+    data = content.encode()
+    if os.path.exists(path):
+        try:
+            with open(path, 'rb') as f:
+                if f.read() == data:
+                    return False
+        except OSError:
+            pass
+
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+    return True
+
+
+def copy_file(source_path, destination_path):
+    # Copy to a temporary file next to the destination and move it into
+    # place so that the destination is never left half written.
+    tmp_path = destination_path + '.tmp'
+    try:
+        shutil.copyfile(source_path, tmp_path)
+        os.replace(tmp_path, destination_path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return
@@ -1,24 +1,135 @@
+import os
+
 from .src_utils import generate_source_files
 from .build_utils import generate_figures
+from .tracing import start_trace, write_trace
+from .common import CFG_FILE_NAME
+from .cache import BuildCache
+from .manifest import read_manifest
+from ..watch import Watcher
 
 
 def generate(source_root_dir, build_root_dir, output_root_dir,
              default_template, default_font, output_format, dev, verbose,
-             dry_run):
+             dry_run, jobs=None, use_cache=True, explain=False,
+             adaptive=False, precompile_preamble=False, batch=False,
+             batch_size=20, trace=None, raster_backend='convert',
+             supersample=2, watch=False, cache_dir=None, cache_size=None,
+             scratch_dir=None, max_memory=None, optimize=False):
     print('*** Cadmus figure generator ***')
 
-    # Generate source files.
-    generate_source_files(source_root_dir=source_root_dir,
-                          output_root_dir=build_root_dir,
-                          default_template=default_template,
-                          default_font=default_font)
+    # Record a timeline of the build if a trace file is specified.
+    if trace:
+        start_trace()
+
+    def build(only_changed=False, changed=None):
+        # Generate source files.
+        delta = generate_source_files(source_root_dir=source_root_dir,
+                                      output_root_dir=build_root_dir,
+                                      default_template=default_template,
+                                      default_font=default_font,
+                                      precompile_preamble=precompile_preamble)
+
+        # Only build the targets whose sources have been added or changed if
+        # requested, i.e. in response to an edit, along with the targets
+        # which read any of the changed files when last compiled, e.g. with
+        # \input.
+        include_dirs = None
+        if only_changed:
+            include_dirs = delta['added'] + delta['changed']
+            inputs = get_input_dirs(build_root_dir)
+            for path in changed or []:
+                for d in inputs.get(os.path.abspath(path), []):
+                    if d not in include_dirs:
+                        include_dirs.append(d)
+            if not include_dirs:
+                print('No targets affected.\n')
+                return delta
+
+        # Generate figures unless dry_run is specified. Target directories
+        # left over from earlier runs are not built.
+        if not dry_run:
+            generate_figures(source_root_dir=build_root_dir,
+                             output_root_dir=output_root_dir,
+                             output_format=output_format,
+                             dev=dev,
+                             verbose=verbose,
+                             jobs=jobs,
+                             use_cache=use_cache,
+                             explain=explain,
+                             exclude_dirs=delta['orphaned'],
+                             adaptive=adaptive,
+                             batch=batch,
+                             batch_size=batch_size,
+                             raster_backend=raster_backend,
+                             supersample=supersample,
+                             include_dirs=include_dirs,
+                             cache_dir=cache_dir,
+                             cache_size=cache_size,
+                             scratch_dir=scratch_dir,
+                             max_memory=max_memory,
+                             optimize=optimize)
+        return delta
+
+    try:
+        delta = build()
+        if watch:
+            watch_sources(source_root_dir, build_root_dir, delta, build)
+    finally:
+        if trace:
+            write_trace(trace)
+
+    return
+
+
+def get_input_dirs(build_root_dir):
+    # Return the files recorded as inputs of the targets by their last
+    # compilation as a dict mapping each file to the directories of the
+    # targets in the build tree which read it.
+    cache = BuildCache(build_root_dir)
+    inputs = {}
+    for entry in read_manifest(build_root_dir) or []:
+        target_dir = os.path.join(build_root_dir,
+                                  os.path.dirname(entry['id']))
+        for path in cache.get_inputs(entry['id']):
+            inputs.setdefault(path, []).append(target_dir)
+    return inputs
+
+
+def watch_sources(source_root_dir, build_root_dir, delta, build):
+    # Rebuild the targets affected by changes to the sources, the
+    # configuration files, the templates or the files read by the targets
+    # until interrupted. The build tree is not watched in case it's placed in
+    # the source tree.
+    def is_source(path):
+        return os.path.basename(path) == CFG_FILE_NAME or \
+            path.endswith('.tex')
+
+    def get_files(delta):
+        return delta['dependencies'] + \
+            sorted(get_input_dirs(build_root_dir))
 
-    # Generate figures unless dry_run is specified.
-    if not dry_run:
-        generate_figures(source_root_dir=build_root_dir,
-                         output_root_dir=output_root_dir,
-                         output_format=output_format,
-                         dev=dev,
-                         verbose=verbose)
+    watcher = Watcher([source_root_dir], get_files(delta), is_source,
+                      [build_root_dir])
+    print('Watching \'' + source_root_dir + '\' for changes (press Ctrl+C '
+          'to stop).')
+    try:
+        while True:
+            changed = sorted(watcher.wait())
+            for path in changed:
+                print('Changed: ' + path)
+            print('')
 
+            # Keep watching if the build fails, e.g. on a malformed
+            # template, until the next change.
+            try:
+                delta = build(only_changed=True, changed=changed)
+            except ValueError as e:
+                print('ERROR: ' + str(e))
+            watcher.set_files(get_files(delta))
+            print('Watching \'' + source_root_dir + '\' for changes.')
+    except KeyboardInterrupt:
+        print('Stopped watching.')
+    finally:
+        watcher.stop()
     return
@@ -0,0 +1,259 @@
+import os
+import glob
+import json
+
+from .common import (CFG_FILE_NAME, MANIFEST_FILE_NAME, write_if_changed,
+                     echo)
+
+
+class CadmusPathError(Exception):
+    def __init__(self, message=''):
+        super(CadmusPathError, self).__init__(message)
+        return
+
+
+TEMPLATES = {
+    'article': 'templates/article.tex'
+}
+
+# The settings of a target along with their default values. The defaults may
+# be overridden by the 'default' object of a configuration file.
+SETTINGS = ['page', 'format', 'passes', 'crop', 'font', 'crop_margins',
+            'width', 'template', 'quality', 'svg_fonts']
+
+
+def get_template_path(root_dir, template):
+    template_path_ret = ''
+    # Check if the template is given by name
+    if template not in TEMPLATES:
+        # Assuming it's a path, check if the file exists.
+        if os.path.isabs(template):
+            # Absolute path, copy straight off.
+            template_path = template
+        else:
+            # The path is taken relative to the configuration file
+            # root directory. Make the path absolute.
+            template_path = os.path.abspath(os.path.join(root_dir, template))
+        if not os.path.exists(template_path):
+            raise CadmusPathError
+        else:
+            # Set to the absolute path
+            template_path_ret = template_path
+    else:
+        # Valid template name, look up the path.
+        template_path_ret = TEMPLATES[template]
+
+    return template_path_ret
+
+
+def is_pattern(file_name):
+    return any(c in file_name for c in '*?[')
+
+
+def read_cfg(root_dir):
+    # Read the configuration file in the directory. Returns None if the file
+    # cannot be read or is invalid.
+    try:
+        with open(os.path.join(root_dir, CFG_FILE_NAME)) as cfg_file:
+            try:
+                cfg = json.load(cfg_file)
+            except ValueError:
+                # Changed from value error in Python 3.5
+                echo('WARNING: Could not parse configuration file, '
+                     'skipping directory.')
+                return None
+    except OSError:
+        echo('WARNING: Failed to open configuration file for '
+             'reading, skipping directory.')
+        return None
+
+    # Validate configuration file contents
+    if 'targets' not in cfg:
+        echo('WARNING: Configuration file did not contain the '
+             'required field \'targets\', skipping directory.')
+        return None
+
+    return cfg
+
+
+def resolve_settings(root_dir, default, entry):
+    # Merge the target entry with the defaults, resolving the template path
+    # relative to the configuration file. Returns None if the entry is
+    # invalid.
+    match = dict(entry)
+    for key in SETTINGS:
+        if key not in match:
+            match[key] = default[key]
+        elif key == 'template':
+            try:
+                match['template'] = get_template_path(root_dir,
+                                                      match['template'])
+            except CadmusPathError:
+                # Neither a valid name nor a valid path.
+                echo('WARNING: The template specified for \'{}\' '
+                     'is neither a valid template name nor a valid '
+                     'path, skipping.'.format(entry['file_name']))
+                return None
+
+    # Validate settings
+    if match['page'] < 1:
+        echo('WARNING: Invalid target page {}, '
+             'valid range: > 0. Skipping this entry.'
+             .format(match['page']))
+        return None
+    if match['passes'] < 1:
+        echo('WARNING: Invalid number of passes {} '
+             'valid range: > 0. Skipping this entry.'
+             .format(match['passes']))
+        return None
+    if match['quality'] is not None and not 1 <= match['quality'] <= 100:
+        echo('WARNING: Invalid image quality {}, '
+             'valid range: 1-100. Skipping this entry.'
+             .format(match['quality']))
+        return None
+    if match['svg_fonts'] not in ['paths', 'embed']:
+        echo('WARNING: Invalid SVG font handling \'{}\', '
+             'valid values: \'paths\', \'embed\'. Skipping this entry.'
+             .format(match['svg_fonts']))
+        return None
+    widths = match['width'] if isinstance(match['width'], list) \
+        else [match['width']]
+    if not widths or min(widths) < 1:
+        echo('WARNING: Invalid image width {}, '
+             'valid range: > 0. Skipping this entry.'
+             .format(match['width']))
+        return None
+
+    return match
+
+
+def discover_targets(source_root_dir, default_template, default_font):
+    # Walk the source directory once in search of configuration files and
+    # return the targets they specify as a list of dicts holding the path to
+    # the source file, the directory of the source file relative to the
+    # source root directory and the resolved settings.
+    #
+    # The 'file_name' of a target entry is either the name of a file relative
+    # to the directory of the configuration file or a glob pattern, e.g.
+    # 'plots/*.tex', in which case the entry applies to every matching file.
+    # A file is assigned the entry of the closest configuration file which
+    # matches it, preferring exact names over patterns and otherwise the
+    # first matching entry.
+    assigned = {}
+
+    for (root_dir, dir_names, file_names) in os.walk(source_root_dir):
+        # Continue walking until a directory with a configuration file is
+        # encountered.
+        if CFG_FILE_NAME not in file_names:
+            continue
+
+        cfg = read_cfg(root_dir)
+        if cfg is None:
+            continue
+
+        # Initialize default configuration and transfer any default settings
+        # from the current configuration file.
+        default = {
+            'page': 1,
+            'format': 'jpg',
+            'passes': 1,
+            'crop': True,
+            'font': default_font,
+            'crop_margins': '10',
+            'width': 1000,
+            'template': default_template,
+            'quality': None,
+            'svg_fonts': 'paths'
+        }
+        c = cfg.get('default', {})
+        for key in SETTINGS:
+            if key in c:
+                default[key] = c[key]
+        if 'template' in c:
+            try:
+                default['template'] = get_template_path(root_dir,
+                                                        c['template'])
+            except CadmusPathError:
+                # Neither a valid name nor a valid path.
+                echo('WARNING: The default template specified in '
+                     '\'{}\' is neither a valid template name nor a '
+                     'valid path, skipping.'
+                     .format(os.path.join(root_dir, CFG_FILE_NAME)))
+                continue
+
+        # Index the entries by file name, keeping the first entry for each
+        # name, and collect the patterns in order.
+        names = {}
+        patterns = []
+        for entry in cfg['targets']:
+            if 'file_name' not in entry:
+                continue
+            if is_pattern(entry['file_name']):
+                patterns.append(entry)
+            else:
+                names.setdefault(entry['file_name'], entry)
+
+        # Match the patterns in reverse order so that the first matching
+        # entry is assigned last, followed by the exact names.
+        matches = {}
+        for entry in reversed(patterns):
+            for path in glob.glob(os.path.join(glob.escape(root_dir),
+                                               entry['file_name']),
+                                  recursive=True):
+                matches[os.path.normpath(path)] = entry
+        for (file_name, entry) in names.items():
+            path = os.path.normpath(os.path.join(root_dir, file_name))
+            if os.path.isfile(path):
+                matches[path] = entry
+
+        # The walk is top-down, so the entries replace those of the
+        # configuration files in the parent directories.
+        for (path, entry) in matches.items():
+            # Skip unsupported file types
+            if not path.endswith('.tex') or not os.path.isfile(path):
+                continue
+            match = resolve_settings(root_dir, default, entry)
+            if match:
+                assigned[path] = match
+
+    targets = []
+    for (path, match) in sorted(assigned.items()):
+        targets.append({
+            'source': path,
+            'local_dir': os.path.relpath(os.path.dirname(path),
+                                         source_root_dir),
+            'name': os.path.splitext(os.path.basename(path))[0],
+            'match': match
+        })
+    return targets
+
+
+def get_target_id(target):
+    # The path to the generated document relative to the build root
+    # directory, e.g. 'plots/sine/sine.tex'.
+    return os.path.normpath(os.path.join(target['local_dir'], target['name'],
+                                         target['name'] + '.tex'))
+
+
+def read_manifest(build_root_dir):
+    # Return the targets recorded in the manifest of the build tree, or None
+    # if there is no manifest.
+    path = os.path.join(build_root_dir, MANIFEST_FILE_NAME)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path) as f:
+            return json.load(f)['targets']
+    except (OSError, ValueError, KeyError):
+        echo('WARNING: Failed to read the manifest \'' + path + '\'.')
+        return None
+
+
+def write_manifest(build_root_dir, targets):
+    # The manifest is left untouched if the targets are unchanged, keeping
+    # its modification time stable like that of the generated sources.
+    path = os.path.join(build_root_dir, MANIFEST_FILE_NAME)
+    write_if_changed(path, json.dumps({'targets': targets}, indent=1,
+                                      sort_keys=True))
+    return
@@ -0,0 +1,75 @@
+import threading
+from contextlib import contextmanager
+
+# Bytes per pixel of an image held in memory by imagemagick, which uses 16
+# bits per channel in its default (Q16) build, and by the PDF renderers.
+IMAGEMAGICK_PIXEL_SIZE = 8
+RENDERER_PIXEL_SIZE = 4
+
+# Memory used by a process regardless of the image size.
+PROCESS_MEMORY = 64 * 1024 ** 2
+
+# Factor applied to the peak memory use measured in earlier runs.
+MEASURED_MARGIN = 1.2
+
+
+def estimate_memory(pixels, tool):
+    # Estimate the peak memory use of a process rendering or converting an
+    # image with the given number of pixels. Imagemagick holds at least two
+    # copies of the image, e.g. while flattening or resizing.
+    if tool == 'convert':
+        return PROCESS_MEMORY + 2 * pixels * IMAGEMAGICK_PIXEL_SIZE
+    return PROCESS_MEMORY + pixels * RENDERER_PIXEL_SIZE
+
+
+class MemoryBudget:
+    # Admits jobs only while the sum of their estimated peak memory use fits
+    # within the budget. A job estimated to need more than the whole budget
+    # is reserved the whole budget, i.e. it runs once nothing else does.
+
+    # Locals
+    size_ = None
+    used_ = 0
+    condition_ = None
+
+    # Constructor
+    def __init__(self, size):
+        self.size_ = size
+        self.used_ = 0
+        self.condition_ = threading.Condition()
+        return
+
+    def acquire(self, amount):
+        # Block until the amount fits within the budget and return the
+        # amount reserved. The whole budget is reserved if the amount is
+        # None, e.g. if it cannot be estimated.
+        amount = self.size_ if amount is None else min(amount, self.size_)
+        with self.condition_:
+            while self.used_ + amount > self.size_:
+                self.condition_.wait()
+            self.used_ += amount
+        return amount
+
+    def try_acquire(self, amount):
+        # Reserve the amount if it fits within the budget right away and
+        # return the amount reserved, otherwise return None.
+        amount = self.size_ if amount is None else min(amount, self.size_)
+        with self.condition_:
+            if self.used_ + amount > self.size_:
+                return None
+            self.used_ += amount
+        return amount
+
+    def release(self, amount):
+        with self.condition_:
+            self.used_ -= amount
+            self.condition_.notify_all()
+        return
+
+    @contextmanager
+    def reserve(self, amount):
+        amount = self.acquire(amount)
+        try:
+            yield amount
+        finally:
+            self.release(amount)
@@ -0,0 +1,126 @@
+import threading
+
+# Optional PDF libraries used to render figures in-process, avoiding the
+# external processes otherwise spawned for every figure. PyMuPDF is preferred
+# over pypdfium2, which also requires Pillow.
+try:
+    import pymupdf
+except ImportError:
+    try:
+        # Versions of PyMuPDF before 1.24.3 are only importable as pymupdf.
+        import fitz as pymupdf
+    except ImportError:
+        pymupdf = None
+
+try:
+    import pypdfium2
+    from PIL import ImageOps
+except ImportError:
+    pypdfium2 = None
+
+# Neither library may be used from several threads at once.
+_render_lock = threading.Lock()
+
+# The border color, matching the color 'gray' in imagemagick.
+BORDER_COLOR = (190, 190, 190)
+
+# The JPEG quality, matching the default of imagemagick.
+JPEG_QUALITY = 92
+
+
+def get_renderer():
+    # Return the name of the library used to render in-process, or None if
+    # no library is installed.
+    if pymupdf:
+        return 'pymupdf'
+    elif pypdfium2:
+        return 'pypdfium2'
+    return None
+
+
+def get_renderer_version():
+    renderer = get_renderer()
+    if renderer == 'pymupdf':
+        return 'PyMuPDF ' + str(getattr(pymupdf, 'VersionBind', None))
+    elif renderer == 'pypdfium2':
+        return 'pypdfium2 ' + str(getattr(pypdfium2, '__version__', None))
+    return None
+
+
+def render_image(file, output_path, output_format, width, border=True,
+                 quality=None):
+    # Render the first page of the PDF to an image of the given width with
+    # the same semantics as the imagemagick path, i.e. on a solid white
+    # background without an alpha channel and with a thin gray border
+    # included in the width. The border may be left out. The quality of a
+    # JPEG image defaults to that of imagemagick.
+    renderer = get_renderer()
+    if not renderer:
+        raise ValueError('No PDF library available for in-process '
+                         'rasterization.')
+
+    with _render_lock:
+        try:
+            if renderer == 'pymupdf':
+                _render_pymupdf(file, output_path, output_format, width,
+                                border, quality or JPEG_QUALITY)
+            else:
+                _render_pypdfium2(file, output_path, output_format, width,
+                                  border, quality or JPEG_QUALITY)
+        except Exception as e:
+            # The libraries raise their own exception types.
+            raise ValueError('Failed to render \'{}\' using {}: {}'
+                             .format(file, renderer, e))
+    return
+
+
+def _render_pymupdf(file, output_path, output_format, width, border,
+                    quality):
+    doc = pymupdf.open(file)
+    try:
+        page = doc[0]
+        scale = (width - 2 if border else width) / page.rect.width
+        pix = page.get_pixmap(matrix=pymupdf.Matrix(scale, scale), alpha=False)
+
+        if border:
+            # Copy the page into the middle of a slightly larger pixmap
+            # filled with the border color.
+            framed = pymupdf.Pixmap(
+                pymupdf.csRGB,
+                pymupdf.IRect(0, 0, pix.width + 2, pix.height + 2),
+                False
+            )
+            framed.set_rect(framed.irect, BORDER_COLOR)
+            pix.set_origin(1, 1)
+            framed.copy(pix, pix.irect)
+            pix = framed
+
+        if output_format == 'jpg':
+            pix.save(output_path, output='jpg', jpg_quality=quality)
+        else:
+            pix.save(output_path, output='png')
+    finally:
+        doc.close()
+    return
+
+
+def _render_pypdfium2(file, output_path, output_format, width, border,
+                      quality):
+    pdf = pypdfium2.PdfDocument(file)
+    try:
+        page = pdf[0]
+        (page_width, page_height) = page.get_size()
+        bitmap = page.render(scale=(width - 2 if border else width) /
+                             page_width,
+                             fill_color=(255, 255, 255, 255))
+        image = bitmap.to_pil().convert('RGB')
+        if border:
+            image = ImageOps.expand(image, border=1, fill=BORDER_COLOR)
+
+        if output_format == 'jpg':
+            image.save(output_path, 'JPEG', quality=quality)
+        else:
+            image.save(output_path, 'PNG')
+    finally:
+        pdf.close()
+    return
@@ -0,0 +1,285 @@
+import io
+import os
+import contextlib
+
+from docutils.parsers.rst import directives
+from docutils.parsers.rst.directives.images import Figure
+
+from .manifest import (TEMPLATES, resolve_settings, get_target_id,
+                       write_manifest)
+from .src_utils import write_source_file
+from .build_utils import (collect_targets, build_target, get_raster_outputs,
+                          get_toolchain_versions, get_store)
+from .cache import BuildCache, hash_file
+from .store import STORE_DIR_VARIABLE, STORE_SIZE_VARIABLE, get_key
+
+# Builds in the same build directory are serialized across the processes
+# reading documents in parallel, where supported.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# A Sphinx extension adding the 'cadmus-figure' directive, which builds a
+# figure from a cadmus figure source when a document referencing it is read
+# and includes the image like the 'figure' directive, e.g.
+#
+#   .. cadmus-figure:: figures/sine.tex
+#      :pixel-width: 800
+#
+#      The caption.
+#
+# Only the figures of the documents read in a build are built. The images
+# are recorded in the environment along with the digests of the files they
+# depend on, and the documents are read again whenever any of these change.
+# Enable the extension by adding 'cadmus.fig.sphinxext' to the extensions in
+# conf.py.
+
+# The toolchain versions, queried once per process.
+_toolchain = None
+
+
+def get_toolchain():
+    global _toolchain
+    if _toolchain is None:
+        _toolchain = get_toolchain_versions()
+    return _toolchain
+
+
+def get_figures(env):
+    # The figures built for the documents, keyed by the digest of their
+    # source path and settings. Each entry holds the path to the image, the
+    # digests of the files it depends on and the documents referencing it.
+    if not hasattr(env, 'cadmus_figures'):
+        env.cadmus_figures = {}
+    return env.cadmus_figures
+
+
+def get_default_template(template, root_dir):
+    # Resolve the templates shipped with cadmus relative to the package and
+    # template paths relative to the given directory, rather than the
+    # working directory.
+    if template in TEMPLATES:
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            TEMPLATES[template])
+    return os.path.join(root_dir, template)
+
+
+def is_current(entry):
+    return os.path.exists(entry['image']) and \
+        all(hash_file(p) == d for (p, d) in entry['digests'].items())
+
+
+@contextlib.contextmanager
+def build_lock(build_root_dir):
+    os.makedirs(build_root_dir, exist_ok=True)
+    with open(os.path.join(build_root_dir, 'cadmus.lock'), 'w') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def build_figure(env, source, entry):
+    # Build the figure from the source with the given settings, unless an
+    # image built with the same settings from the same files is recorded in
+    # the environment. Returns the entry for the figure. Raises ValueError if
+    # the settings are invalid or the figure fails to build, and OSError if
+    # the build directory cannot be written.
+    config = env.config
+    root_dir = os.path.dirname(source)
+    default = {
+        'page': 1,
+        'format': config.cadmus_format,
+        'passes': 1,
+        'crop': True,
+        'font': config.cadmus_font,
+        'crop_margins': '10',
+        'width': config.cadmus_width,
+        'template': config.cadmus_template,
+        'quality': config.cadmus_quality,
+        'svg_fonts': config.cadmus_svg_fonts
+    }
+    if 'template' in entry:
+        entry['template'] = get_default_template(entry['template'], root_dir)
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        match = resolve_settings(root_dir, default, entry)
+    if not match:
+        raise ValueError(out.getvalue().strip())
+
+    key = get_key({'source': source, 'match': match})
+    figures = get_figures(env)
+    if key in figures and is_current(figures[key]):
+        return figures[key]
+
+    build_root_dir = os.path.join(
+        config.cadmus_build_dir or os.path.join(env.doctreedir, 'cadmus'),
+        key[:16]
+    )
+    target = {
+        'source': source,
+        'local_dir': '.',
+        'name': os.path.splitext(os.path.basename(source))[0],
+        'match': match
+    }
+    target['id'] = get_target_id(target)
+
+    # The build is quiet, the output is found in the log of the target.
+    with build_lock(build_root_dir), \
+            contextlib.redirect_stdout(io.StringIO()):
+        write_source_file(target, build_root_dir)
+        write_manifest(build_root_dir, [target])
+        t = collect_targets(build_root_dir, build_root_dir)[0]
+        cache = BuildCache(build_root_dir)
+        store = get_store(config.cadmus_cache_dir, config.cadmus_cache_size)
+        success = build_target(t, config.cadmus_dev, False, cache,
+                               get_toolchain(), False, False, None,
+                               config.cadmus_raster_backend, 2, store,
+                               None, None, config.cadmus_optimize)
+        cache.save()
+    if not success:
+        raise ValueError('Failed to build the figure \'{}\' (see \'{}\').'
+                         .format(source, t['log']))
+
+    # Include the widest image in the first format.
+    outputs = get_raster_outputs(target['name'], t['output_dir'],
+                                 match['format'], match['width'])
+    image = max((o for o in outputs if o[0] == outputs[0][0]),
+                key=lambda o: o[1])[2]
+    dependencies = [source] + match['dependencies'] + \
+        cache.get_inputs(t['id'])
+    figures[key] = {
+        'image': image,
+        'digests': {p: hash_file(p) for p in dependencies},
+        'docnames': set(figures.get(key, {}).get('docnames', []))
+    }
+    return figures[key]
+
+
+def crop(argument):
+    return directives.choice(argument, ('yes', 'no')) == 'yes'
+
+
+class CadmusFigure(Figure):
+    # The options of the figure directive, plus the settings of the target
+    # otherwise given in cadmus.cfg. The width of the image in pixels is
+    # given as 'pixel-width' since 'width' is the width of the figure.
+    option_spec = dict(Figure.option_spec)
+    option_spec.update({
+        'page': directives.positive_int,
+        'format': lambda a: directives.choice(a, ('png', 'jpg', 'webp',
+                                                   'avif', 'svg', 'pdf')),
+        'passes': directives.positive_int,
+        'crop': crop,
+        'crop-margins': directives.unchanged_required,
+        'font': directives.unchanged_required,
+        'template': directives.unchanged_required,
+        'pixel-width': directives.positive_int,
+        'quality': directives.positive_int,
+        'svg-fonts': lambda a: directives.choice(a, ('paths', 'embed'))
+    })
+
+    def run(self):
+        env = self.state.document.settings.env
+        (rel_source, source) = env.relfn2path(self.arguments[0],
+                                              env.docname)
+        env.note_dependency(rel_source)
+
+        entry = {'file_name': os.path.basename(source)}
+        for (option, key) in [('page', 'page'), ('format', 'format'),
+                              ('passes', 'passes'), ('crop', 'crop'),
+                              ('crop-margins', 'crop_margins'),
+                              ('font', 'font'), ('template', 'template'),
+                              ('pixel-width', 'width'),
+                              ('quality', 'quality'),
+                              ('svg-fonts', 'svg_fonts')]:
+            if option in self.options:
+                entry[key] = self.options.pop(option)
+
+        if not os.path.isfile(source):
+            return [self.state.document.reporter.warning(
+                'Figure source \'{}\' not found.'.format(self.arguments[0]),
+                line=self.lineno)]
+        try:
+            figure = build_figure(env, source, entry)
+        except (ValueError, OSError) as e:
+            return [self.state.document.reporter.warning(str(e),
+                                                         line=self.lineno)]
+
+        figure['docnames'].add(env.docname)
+        for path in figure['digests']:
+            env.note_dependency(path)
+
+        # Image paths starting with a slash are relative to the source
+        # directory.
+        self.arguments[0] = '/' + os.path.relpath(
+            figure['image'], env.srcdir).replace(os.sep, '/')
+        return super(CadmusFigure, self).run()
+
+
+def purge_figures(app, env, docname):
+    # Forget the figures no longer referenced by any document.
+    figures = get_figures(env)
+    for (key, figure) in list(figures.items()):
+        figure['docnames'].discard(docname)
+        if not figure['docnames']:
+            del figures[key]
+    return
+
+
+def merge_figures(app, env, docnames, other):
+    # Merge the figures built by the processes reading documents in
+    # parallel.
+    figures = get_figures(env)
+    for (key, figure) in get_figures(other).items():
+        if key in figures:
+            figure['docnames'] |= figures[key]['docnames']
+        figures[key] = figure
+    return
+
+
+def resolve_config_paths(app, config):
+    # Resolve the paths given in conf.py relative to its directory rather
+    # than the working directory.
+    config.cadmus_template = get_default_template(config.cadmus_template,
+                                                  app.confdir)
+    if config.cadmus_build_dir:
+        config.cadmus_build_dir = os.path.join(app.confdir,
+                                               config.cadmus_build_dir)
+    return
+
+
+def evict_cache(app, exception):
+    store = get_store(app.config.cadmus_cache_dir,
+                      app.config.cadmus_cache_size)
+    if store:
+        store.evict()
+    return
+
+
+def setup(app):
+    app.add_config_value('cadmus_template', 'article', 'env')
+    app.add_config_value('cadmus_font', None, 'env')
+    app.add_config_value('cadmus_format', 'png', 'env')
+    app.add_config_value('cadmus_width', 1000, 'env')
+    app.add_config_value('cadmus_quality', None, 'env')
+    app.add_config_value('cadmus_svg_fonts', 'paths', 'env')
+    app.add_config_value('cadmus_dev', False, 'env')
+    app.add_config_value('cadmus_raster_backend', 'convert', 'env')
+    app.add_config_value('cadmus_optimize', False, 'env')
+    app.add_config_value('cadmus_build_dir', None, 'env')
+    app.add_config_value('cadmus_cache_dir',
+                         os.environ.get(STORE_DIR_VARIABLE), '')
+    app.add_config_value('cadmus_cache_size',
+                         os.environ.get(STORE_SIZE_VARIABLE), '')
+
+    app.add_directive('cadmus-figure', CadmusFigure)
+    app.connect('config-inited', resolve_config_paths)
+    app.connect('env-purge-doc', purge_figures)
+    app.connect('env-merge-info', merge_figures)
+    app.connect('build-finished', evict_cache)
+    return {
+        'version': '0.1.0',
+        'env_version': 1,
+        'parallel_read_safe': True,
+        'parallel_write_safe': True
+    }
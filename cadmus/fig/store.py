@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+
+from .common import copy_file
+
+# Environment variables specifying the shared artifact store if not given on
+# the command line.
+STORE_DIR_VARIABLE = 'CADMUS_CACHE_DIR'
+STORE_SIZE_VARIABLE = 'CADMUS_CACHE_SIZE'
+
+# The default size limit of the store.
+DEFAULT_STORE_SIZE = '5G'
+
+# The number of variants of a compiled document kept per key, i.e. builds
+# from the same sources reading different files with \input.
+MAX_VARIANTS = 8
+
+# Seconds after which a temporary directory is considered to be left behind
+# by an interrupted build.
+STALE_TMP_AGE = 3600
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+              'T': 1024 ** 4}
+
+
+def parse_size(size):
+    # Parse a size in bytes with an optional unit, e.g. '500M' or '2G'.
+    s = str(size).strip().upper()
+    if s.endswith('B'):
+        s = s[:-1]
+    unit = s[-1:] if s[-1:] in SIZE_UNITS else ''
+    try:
+        value = float(s[:len(s) - len(unit)])
+    except ValueError:
+        raise ValueError('Invalid size \'{}\'.'.format(size))
+    if value < 0:
+        raise ValueError('Invalid size \'{}\'.'.format(size))
+    return int(value * SIZE_UNITS[unit])
+
+
+def get_key(obj):
+    # Return the digest identifying an object in the store from everything
+    # that affects its contents, given as a JSON serializable object.
+    data = json.dumps(obj, sort_keys=True).encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+def get_umask():
+    # Return the file mode creation mask of the process, which can only be
+    # read by setting it.
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def get_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+
+    size = 0
+    for (root_dir, dir_names, file_names) in os.walk(path):
+        for file_name in file_names:
+            try:
+                size += os.path.getsize(os.path.join(root_dir, file_name))
+            except OSError:
+                pass
+    return size
+
+
+class ArtifactStore:
+    # A content-addressed store of compiled documents and images which may be
+    # shared between build trees, e.g. the worktrees of several developers
+    # and the CI jobs on the same machine. The store is laid out as
+    #   <root>/objects/ab/abcd.../  A directory of files per object
+    #   <root>/index/ab/abcd...     A JSON list of variants per key
+    #   <root>/tmp/                 Objects being written or removed
+    #
+    # Objects are written to a temporary directory and renamed into place and
+    # are never modified once stored, so concurrent builds see either all or
+    # nothing of an object. The modification time of an entry is updated
+    # whenever it's used and the least recently used entries are evicted
+    # once the store exceeds its size limit.
+    #
+    # Entries are created with the permissions given by the umask, like any
+    # other file. To share a store between users, make its root owned by a
+    # common group with the setgid bit set, e.g.
+    #   mkdir -p /var/cache/cadmus && chgrp dev /var/cache/cadmus
+    #   chmod 2775 /var/cache/cadmus
+    # and build with a umask of 002, so that the directories created below
+    # the root inherit the group and every user may add and evict entries.
+
+    # Locals
+    root_ = None
+    max_size_ = None
+    umask_ = None
+
+    # Constructor
+    def __init__(self, root, max_size):
+        self.root_ = os.path.abspath(os.path.expanduser(root))
+        self.max_size_ = max_size
+        self.umask_ = get_umask()
+        for d in ['objects', 'index', 'tmp']:
+            os.makedirs(os.path.join(self.root_, d), exist_ok=True)
+        return
+
+    def get_path(self, kind, key):
+        return os.path.join(self.root_, kind, key[:2], key)
+
+    def fetch(self, key, files):
+        # Copy the files of the object to the paths given as a dict keyed by
+        # the names of the files in the object. Returns False if the object
+        # is not in the store.
+        object_dir = self.get_path('objects', key)
+        try:
+            for (name, path) in sorted(files.items()):
+                copy_file(os.path.join(object_dir, name), path)
+            # Mark the object as recently used.
+            os.utime(object_dir)
+        except OSError:
+            return False
+        return True
+
+    def put(self, key, files):
+        # Store the files given as a dict of paths keyed by the names of the
+        # files in the object. An object which is already stored is left as
+        # is. Returns False if the object could not be stored.
+        object_dir = self.get_path('objects', key)
+        if os.path.exists(object_dir):
+            return True
+
+        try:
+            tmp_dir = tempfile.mkdtemp(dir=os.path.join(self.root_, 'tmp'))
+        except OSError:
+            return False
+
+        try:
+            for (name, path) in sorted(files.items()):
+                shutil.copyfile(path, os.path.join(tmp_dir, name))
+            # mkdtemp() creates the directory readable by its owner only.
+            os.chmod(tmp_dir, 0o777 & ~self.umask_)
+            os.makedirs(os.path.dirname(object_dir), exist_ok=True)
+            os.rename(tmp_dir, object_dir)
+        except OSError:
+            # Another build may have stored the object first.
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return os.path.exists(object_dir)
+        return True
+
+    def get_variants(self, key):
+        # Return the variants recorded for the key, most recent first.
+        path = self.get_path('index', key)
+        try:
+            with open(path) as f:
+                variants = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return []
+        return variants
+
+    def add_variant(self, key, variant):
+        # Record a variant for the key, keeping the most recent ones. A
+        # variant added concurrently by another build may be lost, which
+        # only costs a rebuild.
+        variants = [v for v in self.get_variants(key) if v != variant]
+        variants.insert(0, variant)
+        del variants[MAX_VARIANTS:]
+
+        path = self.get_path('index', key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            (fd, tmp_path) = tempfile.mkstemp(
+                dir=os.path.join(self.root_, 'tmp'))
+            with os.fdopen(fd, 'w') as f:
+                # mkstemp() creates the file readable by its owner only.
+                os.fchmod(f.fileno(), 0o666 & ~self.umask_)
+                json.dump(variants, f, sort_keys=True)
+            os.replace(tmp_path, path)
+        except OSError:
+            return False
+        return True
+
+    def evict(self):
+        # Remove the least recently used entries until the store fits within
+        # its size limit, along with temporary files left behind by
+        # interrupted builds. Returns the number of entries removed.
+        tmp_root = os.path.join(self.root_, 'tmp')
+        now = time.time()
+        for name in os.listdir(tmp_root):
+            path = os.path.join(tmp_root, name)
+            try:
+                if now - os.path.getmtime(path) > STALE_TMP_AGE:
+                    self.remove(path)
+            except OSError:
+                pass
+
+        entries = []
+        total = 0
+        for kind in ['objects', 'index']:
+            kind_root = os.path.join(self.root_, kind)
+            for prefix in os.listdir(kind_root):
+                prefix_dir = os.path.join(kind_root, prefix)
+                for name in os.listdir(prefix_dir):
+                    path = os.path.join(prefix_dir, name)
+                    try:
+                        entry = (os.path.getmtime(path), get_size(path), path)
+                    except OSError:
+                        continue
+                    entries.append(entry)
+                    total += entry[1]
+
+        removed = 0
+        for (mtime, size, path) in sorted(entries):
+            if total <= self.max_size_:
+                break
+            if self.remove(path):
+                removed += 1
+            total -= size
+        return removed
+
+    def remove(self, path):
+        # Move the entry out of the way before removing it so that no build
+        # sees a partially removed object.
+        try:
+            trash_dir = tempfile.mkdtemp(dir=os.path.join(self.root_, 'tmp'))
+        except OSError:
+            return False
+        try:
+            os.rename(path, os.path.join(trash_dir, os.path.basename(path)))
+        except OSError:
+            # Removed by another build.
+            os.rmdir(trash_dir)
+            return False
+        shutil.rmtree(trash_dir, ignore_errors=True)
+        return True
@@ -0,0 +1,106 @@
+from concurrent.futures import wait, FIRST_COMPLETED
+
+
+class TaskGraph:
+    # A graph of tasks, each run by an executor as soon as the tasks it
+    # depends on have succeeded. A task succeeds if it returns a true value.
+    # Tasks depending on a task which fails, or which is skipped, are skipped
+    # without being run. Since the dependencies of a task have to be added
+    # before the task itself, the graph never contains any cycles.
+    #
+    # Tasks are only handed to the executor once a worker is free, taking the
+    # ready tasks with the highest priority first and otherwise in the order
+    # they were added. That way a task which becomes ready later, e.g. a
+    # later stage of a target, does not queue up behind every task which was
+    # ready from the start.
+    #
+    # A task may declare its peak memory use, estimated once it's ready. If a
+    # memory budget is given, the task is not handed to the executor until
+    # its estimate fits within the budget, while other tasks are, and it's
+    # called with the amount reserved for it.
+
+    # Locals
+    tasks_ = None  # A dict of (function, dependencies, priority, memory)
+    # tuples per task name
+
+    # Constructor
+    def __init__(self):
+        self.tasks_ = {}
+        return
+
+    def add(self, name, func, dependencies=None, priority=0, memory=None):
+        # The memory use of the task, if given, is a function returning the
+        # estimate in bytes, or None if unknown, i.e. the whole budget.
+        dependencies = list(dependencies or [])
+        for d in dependencies:
+            if d not in self.tasks_:
+                raise ValueError('Unknown dependency \'{}\' of task \'{}\'.'
+                                 .format(d, name))
+        if name in self.tasks_:
+            raise ValueError('Duplicate task \'{}\'.'.format(name))
+        self.tasks_[name] = (func, dependencies, priority, memory)
+        return name
+
+    def run(self, executor, on_skip=None, max_running=None, budget=None):
+        # Run the tasks and return a dict mapping each task to its status,
+        # i.e. 'done', 'failed' or 'skipped'. At most 'max_running' tasks are
+        # handed to the executor at a time, typically its number of workers.
+        # The callback, if given, is called with the name of each skipped
+        # task. Exceptions raised by a task are propagated without starting
+        # any more tasks.
+        status = {}
+        pending = dict(self.tasks_)
+        running = {}
+        reserved = {}
+        estimates = {}
+        order = {name: i for (i, name) in enumerate(self.tasks_)}
+        try:
+            while pending or running:
+                # Tasks are added in order, so a single pass resolves every
+                # task whose dependencies have completed, including those
+                # skipped in this pass.
+                ready = []
+                for (name, (func, dependencies, priority, memory)) in \
+                        list(pending.items()):
+                    states = [status.get(d) for d in dependencies]
+                    if any(s in ['failed', 'skipped'] for s in states):
+                        del pending[name]
+                        status[name] = 'skipped'
+                        if on_skip:
+                            on_skip(name)
+                    elif all(s == 'done' for s in states):
+                        ready.append(name)
+
+                ready.sort(key=lambda n: (-pending[n][2], order[n]))
+                for name in ready:
+                    if max_running and len(running) >= max_running:
+                        break
+                    (func, dependencies, priority, memory) = pending[name]
+                    if budget and memory:
+                        if name not in estimates:
+                            estimates[name] = memory()
+                        amount = budget.try_acquire(estimates[name])
+                        if amount is None:
+                            # Wait for memory to be released.
+                            continue
+                        future = executor.submit(func, amount)
+                        reserved[future] = amount
+                    else:
+                        future = executor.submit(func)
+                    del pending[name]
+                    running[future] = name
+
+                if not running:
+                    continue
+
+                (done, not_done) = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    if future in reserved:
+                        budget.release(reserved.pop(future))
+                    status[name] = 'done' if future.result() else 'failed'
+        finally:
+            # Don't start any more tasks if interrupted.
+            for future in running:
+                future.cancel()
+        return status
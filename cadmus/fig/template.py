@@ -1,18 +1,64 @@
 import os
 import re
+import threading
+
+from .common import write_if_changed, echo
+from .tracing import span
+
+
+# Parsed templates keyed by absolute path. Each entry holds the modification
+# times of the template's dependencies at the time of parsing along with the
+# parsed template object.
+_template_cache = {}
+_template_cache_lock = threading.Lock()
+
+
+def _get_mtimes(paths):
+    try:
+        return {p: os.stat(p).st_mtime_ns for p in paths}
+    except OSError:
+        return None
+
+
+def get_template(template):
+    # Return a copy of the parsed template, parsing the template only if it's
+    # not in the cache or if the template or any of its @insertfile
+    # dependencies have been modified since it was parsed.
+    key = os.path.abspath(template)
+    with _template_cache_lock:
+        entry = _template_cache.get(key)
+
+    if entry is not None:
+        (mtimes, t) = entry
+        if _get_mtimes(mtimes.keys()) == mtimes:
+            return t.copy()
+
+    with span('parse template: ' + os.path.basename(template), 'source',
+              file=template):
+        t = Template(template)
+    mtimes = _get_mtimes(t.dependencies_)
+    if mtimes is not None:
+        with _template_cache_lock:
+            _template_cache[key] = (mtimes, t)
+
+    return t.copy()
 
 
 class Template:
     # Locals
     template_ = None
-    file_ = None  # Every element is a line in the file
-    markers_ = None  # A dict of line indices, i.e. where to place certain
-    # types of content. Updated when content is added.
+    segments_ = None  # A list of segments, each a list of lines. The
+    # template text and the content slots alternate.
+    markers_ = None  # A dict of segment indices, i.e. which slot receives
+    # certain types of content.
+    dependencies_ = None  # Absolute paths to the template and every file
+    # inserted with @insertfile.
 
     # Constructor
     def __init__(self, template):
-        self.file_ = []
+        self.segments_ = [[]]
         self.markers_ = {}
+        self.dependencies_ = []
         self.parse_template(template)
         return
 
@@ -63,22 +109,22 @@ class Template:
                                 )
                             # Append path to list of files to insert
                             files_to_insert.append(file_path)
-                            self.markers_['file' + str(file_id)] = \
-                                len(self.file_)
+                            token = 'file' + str(file_id)
                             file_id += 1
-                        else:
-                            # Remember where to insert the content type
-                            # indicated by the token.
-                            self.markers_[token] = len(self.file_)
-                            # Append a dummy line to the file to resolve
-                            # content type tokens next to each other.
-                            self.file_.append('')
+                        # Add an empty slot for the content type indicated by
+                        # the token followed by a new segment for the template
+                        # text that comes after it.
+                        self.markers_[token] = len(self.segments_)
+                        self.segments_.append([])
+                        self.segments_.append([])
                     else:
                         # TODO: Maybe silently continue?
                         raise ValueError('Special comment without @-token.')
                 else:
-                    # Regular line, add to the file
-                    self.file_.append(line)
+                    # Regular line, add to the current segment
+                    self.segments_[-1].append(line)
+
+        self.dependencies_ = [os.path.abspath(template)] + files_to_insert
 
         # Insert files
         for (file_id, file_path) in enumerate(files_to_insert):
@@ -89,32 +135,65 @@ class Template:
 
         return
 
+    def copy(self):
+        # Create a copy which can be filled with content without affecting
+        # this object. This avoids parsing the template again.
+        t = Template.__new__(Template)
+        t.template_ = self.template_
+        t.segments_ = [list(segment) for segment in self.segments_]
+        t.markers_ = dict(self.markers_)
+        t.dependencies_ = list(self.dependencies_)
+        return t
+
     def insert_content(self, content, content_type):
         if content_type in self.markers_:
-            # Find insertion point in file
-            ins_idx = self.markers_[content_type]
-            # Insert contents
-            self.file_.insert(ins_idx, content)
-            # Increment markers with index higher or equal to the current
-            # content marker
-            for (content_type, idx) in self.markers_.items():
-                if (idx >= ins_idx):
-                    self.markers_[content_type] += 1
+            # Append the contents to the slot for the content type
+            self.segments_[self.markers_[content_type]].append(content)
         else:
             raise ValueError(
                 'No marker for content type ' + content_type + ' found.')
 
-    def write_file(self, output_path):
+    def render(self):
+        # Concatenate the segments into the complete file contents.
+        return ''.join(line for segment in self.segments_ for line in segment)
+
+    def render_split(self, content_types):
+        # Render the file in two parts. The split is placed at the first slot
+        # of the given content types which has received content, or at the
+        # beginning of the document body if none of them have. The first part
+        # is therefore independent of any content inserted into those slots.
+        split = len(self.segments_)
+        for content_type in content_types:
+            idx = self.markers_.get(content_type)
+            if idx is not None and self.segments_[idx]:
+                split = min(split, idx)
+
+        head = []
+        for line in (line for segment in self.segments_[:split]
+                     for line in segment):
+            if line.startswith('\\begin{document}'):
+                break
+            head.append(line)
+
+        head = ''.join(head)
+        return (head, self.render()[len(head):])
+
+    def write_file(self, output_path, content=None):
+        # The file is only written if its contents differ from what is already
+        # on disk. The rendered template is written unless the content is
+        # given explicitly. Returns True if the file was written.
         dirname = os.path.dirname(output_path)
         if not os.path.exists(dirname):
-            print('Creating directory ' + dirname + '.')
+            echo('Creating directory ' + dirname + '.')
             os.makedirs(dirname)
 
-        with open(output_path, 'w') as f:
-            print(
-                'Writing file \'' + output_path + '\'\n\t using template \'' +
-                self.template_ + '\'.')
+        if content is None:
+            content = self.render()
 
-            f.write(''.join(self.file_))
+        if not write_if_changed(output_path, content):
+            return False
 
-        return
+        echo(
+            'Writing file \'' + output_path + '\'\n\t using template \'' +
+            self.template_ + '\'.')
+        return True
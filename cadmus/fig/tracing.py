@@ -0,0 +1,100 @@
+import os
+import json
+import time
+import threading
+import contextlib
+
+
+class Tracer:
+    # Locals
+    events_ = None  # Complete events in the Chrome trace event format
+    threads_ = None  # A dict of small integer ids for the threads
+    start_ = None
+    lock_ = None
+
+    # Constructor
+    def __init__(self):
+        self.events_ = []
+        self.threads_ = {}
+        self.start_ = time.perf_counter()
+        self.lock_ = threading.Lock()
+        return
+
+    def add(self, name, category, start, end, args):
+        ident = threading.get_ident()
+        with self.lock_:
+            if ident not in self.threads_:
+                self.threads_[ident] = len(self.threads_)
+            self.events_.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': (start - self.start_) * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': os.getpid(),
+                'tid': self.threads_[ident],
+                'args': args
+            })
+        return
+
+    def write(self, path):
+        # Write the events as a JSON object which can be opened in Perfetto or
+        # chrome://tracing, naming each thread after the order in which it
+        # first recorded a span.
+        with self.lock_:
+            events = list(self.events_)
+            for tid in self.threads_.values():
+                events.append({
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'pid': os.getpid(),
+                    'tid': tid,
+                    'args': {'name': 'main' if tid == 0 else
+                             'worker {}'.format(tid)}
+                })
+
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        return
+
+
+# The active tracer, if any.
+_tracer = None
+
+
+def start_trace():
+    global _tracer
+    _tracer = Tracer()
+    return
+
+
+def write_trace(path):
+    # Write the recorded spans to the file and stop tracing.
+    global _tracer
+    if _tracer:
+        print('Writing trace \'' + path + '\'.')
+        _tracer.write(path)
+    _tracer = None
+    return
+
+
+@contextlib.contextmanager
+def span(name, category, **args):
+    # Record the wall time of the enclosed block as a span. The arguments are
+    # attached to the span and may be updated inside the block, e.g. with the
+    # exit status of a process:
+    #   with span('convert', 'raster', file=file) as s:
+    #       s['exit_status'] = p.wait()
+    tracer = _tracer
+    if tracer is None:
+        yield args
+        return
+
+    start = time.perf_counter()
+    try:
+        yield args
+    except BaseException as e:
+        args['error'] = repr(e)
+        raise
+    finally:
+        tracer.add(name, category, start, time.perf_counter(), args)
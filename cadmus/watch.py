@@ -0,0 +1,136 @@
+import os
+import time
+import threading
+
+# The watchdog package, if installed, is used to wake up as soon as a file
+# changes. Otherwise, the watched files are polled.
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+
+# Seconds between scans when polling, and between the safety scans when
+# notified of changes by watchdog.
+POLL_INTERVAL = 0.5
+NOTIFY_INTERVAL = 5.0
+
+# Seconds without further changes before a burst of changes is reported,
+# e.g. an editor saving several files.
+DEBOUNCE_INTERVAL = 0.3
+
+
+class _EventHandler(FileSystemEventHandler if Observer else object):
+    # Locals
+    event_ = None
+
+    # Constructor
+    def __init__(self, event):
+        super(_EventHandler, self).__init__()
+        self.event_ = event
+        return
+
+    def on_any_event(self, event):
+        self.event_.set()
+        return
+
+
+class Watcher:
+    # Locals
+    roots_ = None  # Directories watched recursively
+    files_ = None  # Individual files watched regardless of the filter
+    path_filter_ = None  # Selects the files to watch in the directories
+    exclude_dirs_ = None  # Directories not to descend into
+    snapshot_ = None  # A dict of (mtime, size) per watched file
+    event_ = None
+    observer_ = None
+
+    # Constructor
+    def __init__(self, roots, files=None, path_filter=None,
+                 exclude_dirs=None):
+        self.roots_ = [os.path.abspath(r) for r in roots]
+        self.files_ = [os.path.abspath(f) for f in (files or [])]
+        self.path_filter_ = path_filter
+        self.exclude_dirs_ = set(os.path.abspath(d)
+                                 for d in (exclude_dirs or []))
+        self.event_ = threading.Event()
+        self.snapshot_ = self.scan()
+
+        if Observer:
+            self.observer_ = Observer()
+            handler = _EventHandler(self.event_)
+            for root in self.roots_:
+                self.observer_.schedule(handler, root, recursive=True)
+            for d in set(os.path.dirname(f) for f in self.files_):
+                if os.path.isdir(d):
+                    self.observer_.schedule(handler, d, recursive=False)
+            self.observer_.start()
+        return
+
+    def set_files(self, files):
+        # Replace the individually watched files, e.g. when the templates in
+        # use have changed. Changes to files which were already watched are
+        # still reported.
+        self.files_ = [os.path.abspath(f) for f in files]
+        for (path, stat) in self.scan().items():
+            self.snapshot_.setdefault(path, stat)
+        return
+
+    def scan(self):
+        snapshot = {}
+        paths = list(self.files_)
+        for root in self.roots_:
+            for (root_dir, dir_names, file_names) in os.walk(root):
+                dir_names[:] = [
+                    d for d in dir_names
+                    if os.path.join(root_dir, d) not in self.exclude_dirs_
+                ]
+                for file_name in file_names:
+                    path = os.path.join(root_dir, file_name)
+                    if not self.path_filter_ or self.path_filter_(path):
+                        paths.append(path)
+
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    def poll(self):
+        # Return the set of files which have been added, modified or removed
+        # since the last scan.
+        snapshot = self.scan()
+        changed = set(
+            p for p in set(snapshot) | set(self.snapshot_)
+            if snapshot.get(p) != self.snapshot_.get(p)
+        )
+        self.snapshot_ = snapshot
+        return changed
+
+    def wait(self):
+        # Block until files change and return the set of changed files once
+        # no further changes have been seen for the debounce interval.
+        changed = set()
+        while not changed:
+            if self.observer_:
+                self.event_.wait(NOTIFY_INTERVAL)
+                self.event_.clear()
+            else:
+                time.sleep(POLL_INTERVAL)
+            changed = self.poll()
+
+        while True:
+            time.sleep(DEBOUNCE_INTERVAL)
+            self.event_.clear()
+            more = self.poll()
+            if not more:
+                return changed
+            changed |= more
+
+    def stop(self):
+        if self.observer_:
+            self.observer_.stop()
+            self.observer_.join()
+        return